@@ -0,0 +1,312 @@
+# -*- coding:utf-8 -*-
+"""In-memory columnar store of wireless charges for analytics across
+billing cycles.
+
+Charges are loaded straight from the database cursor into `array` columns,
+without creating a model instance per row. Lines, charge types and billing
+cycles are dictionary encoded: columns hold small integer codes that index
+into lists of dimension values. NumPy is used for group-by when installed
+(`pip install att-bill-splitter[analytics]`), pure python otherwise.
+
+Unusual charges are found by comparing each charge of a line with a rolling
+baseline of the same charge type over the previous billing cycles of the
+line. This needs NumPy.
+"""
+
+from __future__ import division, unicode_literals
+from array import array
+from collections import namedtuple
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from attbillsplitter.models import (
+    User, ChargeCategory, ChargeType, BillingCycle, Charge, db
+)
+
+Line = namedtuple('Line', ['id', 'name', 'number'])
+Cycle = namedtuple('Cycle', ['id', 'name', 'end_date'])
+Type = namedtuple('Type', ['id', 'text'])
+Anomaly = namedtuple(
+    'Anomaly',
+    ['billing_cycle', 'name', 'number', 'charge_type', 'amount', 'baseline',
+     'z_score']
+)
+
+COLUMNS = ('billing_cycle', 'user', 'charge_type')
+
+
+class ChargeStore(object):
+    """Wireless charges held in array-backed columns.
+
+    `billing_cycle`, `user` and `charge_type` columns hold codes into
+    `billing_cycles`, `users` and `charge_types`. Billing cycles are coded
+    in order of their end date. Charges of archived billing cycles are not
+    in the main database and so are not loaded.
+    """
+
+    def __init__(self, billing_cycles, users, charge_types):
+        self.billing_cycles = billing_cycles
+        self.users = users
+        self.charge_types = charge_types
+        self.billing_cycle = array(str('i'))
+        self.user = array(str('i'))
+        self.charge_type = array(str('i'))
+        self.amount = array(str('d'))
+
+    def __len__(self):
+        return len(self.amount)
+
+    @classmethod
+    def load(cls, database=db):
+        """Load all wireless charges in database.
+
+        :param database: database
+        :type database: SqliteDatabase
+        :returns: charge store
+        :rtype: ChargeStore
+        """
+        bcs = [Cycle(*row) for row in BillingCycle.select(
+            BillingCycle.id, BillingCycle.name, BillingCycle.end_date
+        ).order_by(BillingCycle.end_date).tuples()]
+        users = [Line(*row) for row in User.select(
+            User.id, User.name, User.number
+        ).order_by(User.id).tuples()]
+        charge_types = [Type(*row) for row in ChargeType.select(
+            ChargeType.id, ChargeType.text
+        ).order_by(ChargeType.id).tuples()]
+        store = cls(bcs, users, charge_types)
+        bc_codes = {bc.id: code for code, bc in enumerate(bcs)}
+        user_codes = {user.id: code for code, user in enumerate(users)}
+        ct_codes = {ct.id: code for code, ct in enumerate(charge_types)}
+
+        query = (
+            Charge
+            .select(Charge.billing_cycle,
+                    Charge.user,
+                    Charge.charge_type,
+                    Charge.amount)
+            .join(ChargeType)
+            .join(ChargeCategory)
+            .where(ChargeCategory.category == 'wireless')
+        )
+        # iterate the cursor directly, peewee would cache every row
+        cursor = database.execute_sql(*query.sql())
+        for bc_id, user_id, ct_id, amount in cursor:
+            store.billing_cycle.append(bc_codes[bc_id])
+            store.user.append(user_codes[user_id])
+            store.charge_type.append(ct_codes[ct_id])
+            store.amount.append(amount)
+        return store
+
+    def filter(self, billing_cycles=None, users=None, charge_types=None):
+        """Select charges by dimension values.
+
+        :param billing_cycles: names of billing cycles to keep
+        :type billing_cycles: list
+        :param users: numbers of lines to keep
+        :type users: list
+        :param charge_types: texts of charge types to keep
+        :type charge_types: list
+        :returns: charge store sharing dimensions with this store
+        :rtype: ChargeStore
+        """
+        wanted = [
+            ('billing_cycle', self.billing_cycles, 'name', billing_cycles),
+            ('user', self.users, 'number', users),
+            ('charge_type', self.charge_types, 'text', charge_types),
+        ]
+        masks = []
+        for column, values, attr, keep in wanted:
+            if keep is not None:
+                keep = set(keep)
+                codes = set(code for code, value in enumerate(values)
+                            if getattr(value, attr) in keep)
+                masks.append((getattr(self, column), codes))
+
+        store = ChargeStore(self.billing_cycles, self.users,
+                            self.charge_types)
+        if np is not None and len(self):
+            mask = np.ones(len(self), dtype=bool)
+            for column, codes in masks:
+                mask &= np.isin(np.asarray(column), list(codes))
+            for column in COLUMNS + ('amount',):
+                selected = np.asarray(getattr(self, column))[mask]
+                getattr(store, column).extend(selected.tolist())
+            return store
+
+        for i in range(len(self)):
+            if all(column[i] in codes for column, codes in masks):
+                store.billing_cycle.append(self.billing_cycle[i])
+                store.user.append(self.user[i])
+                store.charge_type.append(self.charge_type[i])
+                store.amount.append(self.amount[i])
+        return store
+
+    def group_sum(self, *by):
+        """Sum amounts grouped by dimensions.
+
+        :param by: names of columns to group by, any of 'billing_cycle',
+            'user', 'charge_type' and 'year' (year of billing cycle end date)
+        :type by: str
+        :returns: dict of tuple of codes (years for 'year') to total
+        :rtype: dict
+        """
+        keys = [self.get_codes(column) for column in by]
+        if np is not None and len(self):
+            return self._group_sum_numpy(keys)
+
+        totals = {}
+        for i, amount in enumerate(self.amount):
+            key = tuple(codes[i] for codes in keys)
+            totals[key] = totals.get(key, 0.0) + amount
+        return totals
+
+    def _group_sum_numpy(self, keys):
+        keys = [np.asarray(codes) for codes in keys]
+        amounts = np.frombuffer(self.amount, dtype=np.float64)
+        if not keys:
+            return {(): float(amounts.sum())}
+
+        offsets = [codes.min() for codes in keys]
+        dims = [int(codes.max() - offset) + 1
+                for codes, offset in zip(keys, offsets)]
+        flat = np.ravel_multi_index(
+            [codes - offset for codes, offset in zip(keys, offsets)], dims
+        )
+        totals = np.bincount(flat, weights=amounts)
+        present = np.flatnonzero(np.bincount(flat))
+        return {
+            tuple(int(code + offset) for code, offset in zip(
+                np.unravel_index(index, dims), offsets)): float(totals[index])
+            for index in present
+        }
+
+    def get_codes(self, column):
+        """Get column of codes, or of years for 'year'.
+
+        :param column: name of column
+        :type column: str
+        :returns: codes
+        :rtype: array or numpy.ndarray
+        """
+        if column == 'year':
+            years = [bc.end_date.year for bc in self.billing_cycles]
+            if np is not None and len(self):
+                return np.asarray(years)[np.asarray(self.billing_cycle)]
+
+            return array(str('i'), (years[code]
+                                    for code in self.billing_cycle))
+
+        if column not in COLUMNS:
+            raise ValueError('Unknown column {}'.format(column))
+
+        return getattr(self, column)
+
+    def yearly_totals(self):
+        """Get total wireless charges of each line in each year.
+
+        :returns: dict of (number, year) to total
+        :rtype: dict
+        """
+        return {
+            (self.users[user].number, year): total
+            for (user, year), total in self.group_sum('user', 'year').items()
+        }
+
+    def type_trend(self, charge_type):
+        """Get totals of a charge type over billing cycles.
+
+        :param charge_type: text of charge type
+        :type charge_type: str
+        :returns: list of tuples of billing cycle name and total, ordered by
+            billing cycle
+        :rtype: list
+        """
+        totals = self.filter(charge_types=[charge_type]).group_sum(
+            'billing_cycle'
+        )
+        return [(self.billing_cycles[bc].name, total)
+                for (bc,), total in sorted(totals.items())]
+
+
+def find_anomalies(store, billing_cycles=None, threshold=3.0, window=6,
+                   min_periods=3, min_std=1.0):
+    """Find charges far from the rolling baseline of their line and charge
+    type.
+
+    Amounts of each line and charge type form a series over billing cycles,
+    0 in cycles without the charge. The baseline of a cycle is the mean and
+    standard deviation of the previous `window` cycles since the line first
+    appeared. All series are scored at once with cumulative sums.
+    :param store: charges
+    :type store: ChargeStore
+    :param billing_cycles: names of billing cycles to report. Default to all
+    :type billing_cycles: list
+    :param threshold: absolute z-score from which a charge is unusual
+    :type threshold: float
+    :param window: number of previous billing cycles in baseline
+    :type window: int
+    :param min_periods: number of previous billing cycles needed to score
+    :type min_periods: int
+    :param min_std: floor of standard deviation, so that small changes of a
+        steady charge are not flagged
+    :type min_std: float
+    :returns: unusual charges ordered by billing cycle and line
+    :rtype: list
+    """
+    if np is None:
+        raise ImportError('NumPy is required to find unusual charges. '
+                          'Install att-bill-splitter[analytics].')
+
+    if not len(store):
+        return []
+
+    bc_codes = np.asarray(store.billing_cycle)
+    user_codes = np.asarray(store.user)
+    ct_codes = np.asarray(store.charge_type)
+    # one series per line and charge type found in charges
+    keys = user_codes.astype(np.int64) * len(store.charge_types) + ct_codes
+    series_keys, series = np.unique(keys, return_inverse=True)
+    series_users = series_keys // len(store.charge_types)
+    series_types = series_keys % len(store.charge_types)
+    n_cycles = len(store.billing_cycles)
+    amounts = np.zeros((len(series_keys), n_cycles))
+    np.add.at(amounts, (series, bc_codes),
+              np.frombuffer(store.amount, dtype=np.float64))
+
+    # baseline of cycle t covers cycles [start, t)
+    first_cycles = np.full(len(store.users), n_cycles)
+    np.minimum.at(first_cycles, user_codes, bc_codes)
+    cycles = np.arange(n_cycles)
+    start = np.maximum(cycles - window, 0)[np.newaxis, :]
+    start = np.maximum(start, first_cycles[series_users][:, np.newaxis])
+    start = np.minimum(start, cycles)
+    counts = cycles - start
+    zeros = np.zeros((len(series_keys), 1))
+    sums = np.hstack([zeros, np.cumsum(amounts, axis=1)])
+    squares = np.hstack([zeros, np.cumsum(amounts ** 2, axis=1)])
+    rows = np.arange(len(series_keys))[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (sums[:, :-1] - sums[rows, start]) / counts
+        variances = (squares[:, :-1] - squares[rows, start]) / counts
+        stds = np.sqrt(np.maximum(variances - means ** 2, 0))
+        z_scores = (amounts - means) / np.maximum(stds, min_std)
+    unusual = (counts >= min_periods) & (np.abs(z_scores) >= threshold)
+
+    if billing_cycles is not None:
+        names = set(billing_cycles)
+        wanted = np.array([bc.name in names for bc in store.billing_cycles],
+                          dtype=bool)
+        unusual &= wanted[np.newaxis, :]
+    anomalies = []
+    # series are ordered by line, so transposed indices are ordered by
+    # billing cycle and line
+    for t, s in zip(*np.nonzero(unusual.T)):
+        user = store.users[series_users[s]]
+        anomalies.append(Anomaly(
+            store.billing_cycles[t].name, user.name, user.number,
+            store.charge_types[series_types[s]].text, float(amounts[s, t]),
+            float(means[s, t]), float(z_scores[s, t])
+        ))
+    return anomalies
@@ -0,0 +1,427 @@
+# -*- coding:utf-8 -*-
+"""Read-only local HTTP API serving billing cycles and charges as JSON.
+
+Endpoints:
+    * GET /billing-cycles
+    * GET /billing-cycles/<id>/summary
+    * GET /billing-cycles/<id>/details
+
+Lists are paginated with `page` and `per_page` query parameters. Charges of
+a billing cycle only change when it is re-split or archived, which bumps its
+`updated_at`, so responses carry an ETag and Last-Modified derived from it
+and conditional requests are answered with 304 before any report query runs.
+The ETag also covers the number and largest id of rows, so that two writes
+within the same second of Last-Modified still change it.
+
+Queries are the ones of the report engine, run on a small pool of read-only
+SQLite connections shared by request threads. The API never writes.
+"""
+
+from __future__ import print_function, unicode_literals
+from collections import namedtuple
+from contextlib import contextmanager
+import datetime as dt
+from email.utils import formatdate, parsedate_tz, mktime_tz
+import calendar
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, quote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote
+    from urlparse import parse_qs, urlparse
+import click
+import peewee as pw
+import attbillsplitter.utils as utils
+from attbillsplitter.migrations import MIGRATIONS
+from attbillsplitter.models import BillingCycle, Charge
+from attbillsplitter.reports import iter_line_reports
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 500
+# largest integer SQLite can store
+MAX_ID = 2 ** 63 - 1
+
+logger = logging.getLogger(__name__)
+
+# plain record of a billing cycle read from a pooled connection
+Cycle = namedtuple(
+    'Cycle',
+    ['id', 'name', 'start_date', 'end_date', 'archived_at', 'last_modified']
+)
+
+
+class ApiError(Exception):
+    """Error answered with a JSON body and an HTTP status."""
+
+    def __init__(self, status, message):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+class ConnectionPool(object):
+    """Read-only SQLite connections shared by threads. At most `size`
+    connections are opened, a thread waits for a free one beyond that.
+    """
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        try:
+            conn = sqlite3.connect(
+                'file:{}?mode=ro'.format(quote(self.path)), uri=True,
+                check_same_thread=False
+            )
+        except TypeError:
+            # python 2 cannot open uri, refuse writes on connection instead
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the context."""
+        with self.lock:
+            new = self.idle.empty() and self.opened < self.size
+            if new:
+                self.opened += 1
+        if not new:
+            conn = self.idle.get()
+        else:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def execute(self, query):
+        """Run a peewee query on a pooled connection.
+
+        :param query: query
+        :type query: SelectQuery
+        :returns: rows as tuples
+        :rtype: list
+        """
+        with self.connection() as conn:
+            return conn.execute(*query.sql()).fetchall()
+
+    def close(self):
+        """Close idle connections."""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def cycle_query():
+    """Query billing cycles as rows of `Cycle`, latest first.
+
+    :rtype: SelectQuery
+    """
+    return (
+        BillingCycle
+        .select(BillingCycle.id,
+                BillingCycle.name,
+                BillingCycle.start_date,
+                BillingCycle.end_date,
+                BillingCycle.archived_at,
+                pw.fn.COALESCE(BillingCycle.updated_at,
+                               BillingCycle.created_at))
+        .order_by(BillingCycle.end_date.desc())
+        .tuples()
+    )
+
+
+def parse_timestamp(value):
+    """Parse a UTC timestamp stored by SQLite or peewee.
+
+    :param value: timestamp, e.g. '2016-04-15 08:00:00.123456'
+    :type value: str
+    :returns: seconds since epoch, None if value is None
+    :rtype: int
+    """
+    if value is None:
+        return None
+
+    parsed = dt.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(parsed.timetuple())
+
+
+def make_etag(*parts):
+    """Make a strong ETag from the parts identifying a response.
+
+    :rtype: str
+    """
+    key = '-'.join('{}'.format(part) for part in parts)
+    return '"{}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def cycle_to_json(cycle):
+    return {
+        'id': cycle.id,
+        'name': cycle.name,
+        'start_date': cycle.start_date,
+        'end_date': cycle.end_date,
+        'archived': cycle.archived_at is not None,
+    }
+
+
+def paginate(params):
+    """Get page and number of items per page from query parameters.
+
+    :param params: query parameters
+    :type params: dict
+    :returns: tuple of page and per page
+    :rtype: tuple
+    """
+    try:
+        page = int(params.get('page', ['1'])[0])
+        per_page = int(params.get('per_page', [DEFAULT_PER_PAGE])[0])
+    except ValueError:
+        raise ApiError(400, 'page and per_page must be integers')
+
+    if page < 1 or not 1 <= per_page <= MAX_PER_PAGE:
+        raise ApiError(400, 'page must be positive and per_page between 1 '
+                            'and {}'.format(MAX_PER_PAGE))
+    # offset of page must fit in a SQLite integer
+    if (page - 1) * per_page > MAX_ID:
+        raise ApiError(400, 'page is out of range')
+    return page, per_page
+
+
+def page_json(items, page, per_page, total):
+    return {
+        'items': items,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'next_page': page + 1 if page * per_page < total else None,
+    }
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """Route GET requests to billing cycle resources."""
+
+    routes = [
+        (re.compile(r'^/billing-cycles/?$'), 'list_cycles'),
+        (re.compile(r'^/billing-cycles/(\d+)/summary/?$'), 'get_summary'),
+        (re.compile(r'^/billing-cycles/(\d+)/details/?$'), 'get_details'),
+    ]
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            for pattern, name in self.routes:
+                m = pattern.match(url.path)
+                if m:
+                    getattr(self, name)(params, *m.groups())
+                    break
+            else:
+                raise ApiError(404, 'Not found')
+
+        except ApiError as e:
+            self.set_response(e.status, {'error': str(e)})
+        except Exception as e:
+            logger.exception('error serving %s', self.path)
+            self.set_response(500, {'error': '{}: {}'.format(
+                type(e).__name__, e)})
+        self.flush_response(send_body)
+
+    def set_response(self, status, data, etag=None, last_modified=None):
+        self.status = status
+        self.headers_out = [('Content-Type',
+                             'application/json; charset=utf-8'),
+                            ('Cache-Control', 'no-cache')]
+        if etag:
+            self.headers_out.append(('ETag', etag))
+        if last_modified is not None:
+            self.headers_out.append(
+                ('Last-Modified', formatdate(last_modified, usegmt=True))
+            )
+        self.body = b''
+        if data is not None:
+            self.body = json.dumps(data, sort_keys=True).encode('utf-8')
+
+    def flush_response(self, send_body):
+        self.send_response(self.status)
+        for name, value in self.headers_out:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(self.body)
+
+    def not_modified(self, etag, last_modified):
+        """Check conditional request headers. If-None-Match takes precedence
+        over If-Modified-Since.
+
+        :rtype: bool
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and last_modified is not None:
+            parsed = parsedate_tz(if_modified_since)
+            return parsed is not None and last_modified <= mktime_tz(parsed)
+        return False
+
+    def respond(self, data, etag, last_modified):
+        if self.not_modified(etag, last_modified):
+            self.set_response(304, None, etag, last_modified)
+        else:
+            self.set_response(200, data, etag, last_modified)
+
+    def get_cycle(self, bc_id):
+        rows = []
+        if int(bc_id) <= MAX_ID:
+            rows = self.server.pool.execute(
+                cycle_query().where(BillingCycle.id == int(bc_id))
+            )
+        if not rows:
+            raise ApiError(404, 'Billing cycle {} not found'.format(bc_id))
+
+        return Cycle(*rows[0])
+
+    def list_cycles(self, params):
+        pool = self.server.pool
+        total, max_id, updated_at = pool.execute(
+            BillingCycle.select(
+                pw.fn.COUNT(BillingCycle.id),
+                pw.fn.MAX(BillingCycle.id),
+                pw.fn.MAX(pw.fn.COALESCE(BillingCycle.updated_at,
+                                         BillingCycle.created_at))
+            ).tuples()
+        )[0]
+        page, per_page = paginate(params)
+        last_modified = parse_timestamp(updated_at)
+        etag = make_etag('cycles', total, max_id, updated_at, page,
+                         per_page)
+        if self.not_modified(etag, last_modified):
+            return self.set_response(304, None, etag, last_modified)
+
+        cycles = [Cycle(*row) for row in
+                  pool.execute(cycle_query().paginate(page, per_page))]
+        self.respond(page_json([cycle_to_json(c) for c in cycles], page,
+                               per_page, total), etag, last_modified)
+
+    def get_reports(self, params, bc_id, kind):
+        page, per_page = paginate(params)
+        cycle = self.get_cycle(bc_id)
+        count, max_id = self.server.pool.execute(
+            Charge.select(pw.fn.COUNT(Charge.id), pw.fn.MAX(Charge.id))
+            .where(Charge.billing_cycle == cycle.id)
+            .tuples()
+        )[0]
+        # stored with microseconds, Last-Modified only has seconds
+        etag = make_etag(kind, cycle.id, cycle.last_modified, count, max_id,
+                         page, per_page)
+        cycle = cycle._replace(
+            last_modified=parse_timestamp(cycle.last_modified)
+        )
+        # charges are only queried when the client copy is stale
+        if self.not_modified(etag, cycle.last_modified):
+            return self.set_response(304, None, etag, cycle.last_modified)
+
+        reports = list(iter_line_reports([cycle], self.server.pool.execute))
+        lines = []
+        for report in reports[(page - 1) * per_page:page * per_page]:
+            line = {'name': report.name, 'number': report.number,
+                    'total': round(report.total, 2)}
+            if kind == 'details':
+                line['charges'] = [
+                    {'charge_type': text, 'amount': round(amount, 2)}
+                    for text, amount in report.charges
+                ]
+            lines.append(line)
+        data = page_json(lines, page, per_page, len(reports))
+        data['billing_cycle'] = cycle_to_json(cycle)
+        data['wireless_total'] = round(sum(r.total for r in reports), 2)
+        self.respond(data, etag, cycle.last_modified)
+
+    def get_summary(self, params, bc_id):
+        self.get_reports(params, bc_id, 'summary')
+
+    def get_details(self, params, bc_id):
+        self.get_reports(params, bc_id, 'details')
+
+
+class ApiServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread."""
+
+    daemon_threads = True
+
+    def __init__(self, address, pool):
+        HTTPServer.__init__(self, address, ApiHandler)
+        self.pool = pool
+
+
+def get_pool_schema_version(pool):
+    with pool.connection() as conn:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', '-p', type=int, default=8000, show_default=True)
+@click.option('--pool-size', type=int, default=4, show_default=True,
+              help='Number of read-only database connections.')
+@click.option('--database', default=utils.DATABASE_PATH, show_default=True,
+              help='Path to bill database.')
+def run_serve_api(host, port, pool_size, database):
+    """Serve billing cycles, monthly summaries and charge details of users
+    as JSON over HTTP. The database is opened read-only.
+    """
+    pool = ConnectionPool(database, pool_size)
+    try:
+        version = get_pool_schema_version(pool)
+    except sqlite3.Error as e:
+        raise click.ClickException('Cannot open {}: {}'.format(database, e))
+
+    if version < len(MIGRATIONS):
+        raise click.ClickException('Database schema is outdated. Run '
+                                   'att-migrate-db first.')
+
+    server = ApiServer((host, port), pool)
+    print('\U0001F310  Serving bills on http://{}:{}/billing-cycles'.format(
+        host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
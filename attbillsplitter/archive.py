@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+"""Archive charges of old billing cycles.
+
+Charges of billing cycles older than a retention window are folded into
+ChargeSummary, moved to a separate archive database and removed from the
+main database. MonthlyBill totals are kept so that summaries of archived
+billing cycles can still be printed.
+"""
+
+from __future__ import print_function, unicode_literals
+import datetime as dt
+import click
+import peewee as pw
+import attbillsplitter.utils as utils
+from attbillsplitter.main import create_tables_if_not_exist
+from attbillsplitter.models import BillingCycle, Charge, ChargeSummary, db
+
+
+def get_cutoff_date(months, today=None):
+    """Get the first day of the month `months` months before today.
+
+    :param months: number of months to retain
+    :type months: int
+    :param today: date to count from. Default to today
+    :type today: datetime.date
+    :returns: cutoff date
+    :rtype: datetime.date
+    """
+    today = today or dt.date.today()
+    month_index = today.year * 12 + today.month - 1 - months
+    return dt.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def add_missing_columns(database, model, schema):
+    """Add columns of a model missing from its table in an attached
+    database, e.g. columns added to the main database by later migrations.
+
+    :param database: database
+    :type database: SqliteDatabase
+    :param model: model of table
+    :type model: Model
+    :param schema: name of attached database
+    :type schema: str
+    :returns: None
+    """
+    table = model._meta.db_table
+    columns = set(
+        row[1] for row in database.execute_sql(
+            'PRAGMA {}.table_info("{}")'.format(schema, table)
+        ).fetchall()
+    )
+    for field in model._meta.sorted_fields:
+        if field.db_column not in columns:
+            database.execute_sql('ALTER TABLE {}."{}" ADD COLUMN "{}" '
+                                 '{}'.format(schema, table, field.db_column,
+                                             field.get_db_field()))
+
+
+def archive_billing_cycles(months, archive_path=utils.ARCHIVE_DATABASE_PATH,
+                           database=db):
+    """Archive billing cycles ending before the retention window.
+
+    :param months: number of months of billing cycles to keep in detail
+    :type months: int
+    :param archive_path: path to archive database
+    :type archive_path: str
+    :param database: database
+    :type database: SqliteDatabase
+    :returns: billing cycles archived
+    :rtype: list
+    """
+    cutoff_date = get_cutoff_date(months)
+    bcs = list(
+        BillingCycle
+        .select()
+        .where(BillingCycle.end_date < cutoff_date,
+               BillingCycle.archived_at >> None)
+        .order_by(BillingCycle.end_date)
+    )
+    if not bcs:
+        return bcs
+
+    bc_ids = [bc.id for bc in bcs]
+    placeholders = ', '.join('?' for _ in bc_ids)
+    charge_table = Charge._meta.db_table
+    # named so that rows are copied whatever the column order of each table
+    columns = ', '.join('"{}"'.format(f.db_column)
+                        for f in Charge._meta.sorted_fields)
+    # ATTACH is not allowed inside a transaction
+    database.execute_sql('ATTACH DATABASE ? AS archive', (archive_path,))
+    try:
+        database.execute_sql(
+            'CREATE TABLE IF NOT EXISTS archive."{0}" AS '
+            'SELECT * FROM main."{0}" WHERE 0'.format(charge_table)
+        )
+        database.execute_sql(
+            'CREATE INDEX IF NOT EXISTS archive."{0}_billing_cycle_id" '
+            'ON "{0}" ("billing_cycle_id")'.format(charge_table)
+        )
+        add_missing_columns(database, Charge, 'archive')
+        with database.atomic():
+            summary = (
+                Charge
+                .select(Charge.billing_cycle,
+                        Charge.charge_type,
+                        pw.fn.SUM(Charge.amount),
+                        pw.fn.COUNT(Charge.id))
+                .where(Charge.billing_cycle << bc_ids)
+                .group_by(Charge.billing_cycle, Charge.charge_type)
+                .tuples()
+            )
+            rows = [{'billing_cycle': bc_id, 'charge_type': ct_id,
+                     'total': total, 'line_count': line_count}
+                    for (bc_id, ct_id, total, line_count) in summary]
+            # keep SQLite below its limit of 999 variables per statement
+            for i in range(0, len(rows), 100):
+                ChargeSummary.insert_many(rows[i:i + 100]).execute()
+            database.execute_sql(
+                'INSERT INTO archive."{0}" ({1}) SELECT {1} FROM main."{0}" '
+                'WHERE billing_cycle_id IN ({2})'.format(charge_table,
+                                                         columns,
+                                                         placeholders),
+                bc_ids
+            )
+            Charge.delete().where(Charge.billing_cycle << bc_ids).execute()
+            BillingCycle.update(
+                archived_at=dt.datetime.utcnow(),
+                updated_at=dt.datetime.utcnow()
+            ).where(BillingCycle.id << bc_ids).execute()
+    finally:
+        database.execute_sql('DETACH DATABASE archive')
+
+    # reclaim space and refresh planner statistics
+    database.execute_sql('VACUUM')
+    database.execute_sql('ANALYZE')
+    return bcs
+
+
+@click.command()
+@click.option('--months', '-m', type=int, default=24, show_default=True,
+              help='Number of months of billing cycles to keep in detail.')
+@click.option('--archive-path', default=utils.ARCHIVE_DATABASE_PATH,
+              show_default=True, help='Path to archive database.')
+def run_archive(months, archive_path):
+    """Move charge details of billing cycles older than MONTHS months to an
+    archive database. Monthly totals and per charge type sums are kept.
+    """
+    create_tables_if_not_exist()
+    bcs = archive_billing_cycles(months, archive_path)
+    for bc in bcs:
+        print('\U0001F4E6  Billing Cycle {} archived.'.format(bc.name))
+    if not bcs:
+        print('\U000026A0  No billing cycle to archive.')
@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+"""Identity map for the small dimension tables used during bill splitting.
+
+User, ChargeCategory and ChargeType rows are loaded with one query each and
+looked up in memory. Only missing rows are inserted, in a batch.
+"""
+
+from __future__ import unicode_literals
+from attbillsplitter.errors import IntegrityError
+from attbillsplitter.models import User, ChargeCategory, ChargeType, db
+
+
+class IdentityMap(object):
+    """Per-process cache of User, ChargeCategory and ChargeType rows.
+
+    The cache is reloaded when the database connection changes or when
+    `PRAGMA data_version` reports that another connection committed since
+    the cache was loaded.
+    """
+
+    def __init__(self, database=db):
+        self.database = database
+        self.conn = None
+        self.data_version = None
+        self.users = {}
+        self.charge_categories = {}
+        self.charge_types = {}
+
+    def get_data_version(self):
+        cursor = self.database.execute_sql('PRAGMA data_version')
+        return cursor.fetchone()[0]
+
+    def load(self):
+        """Load all dimension rows, one query per table.
+
+        :returns: None
+        """
+        self.conn = self.database.get_conn()
+        self.data_version = self.get_data_version()
+        self.users = {(u.name, u.number): u for u in User.select()}
+        self.charge_categories = {
+            c.category: c for c in ChargeCategory.select()
+        }
+        self.charge_types = {
+            (ct.type, ct.charge_category_id): ct
+            for ct in ChargeType.select()
+        }
+
+    def invalidate(self):
+        """Drop cached rows. They will be reloaded on next refresh.
+
+        :returns: None
+        """
+        self.conn = None
+        self.data_version = None
+
+    def refresh(self):
+        """Reload the cache if it may be stale.
+
+        :returns: None
+        """
+        if (self.conn is None or self.conn is not self.database.get_conn() or
+                self.data_version != self.get_data_version()):
+            self.load()
+
+    def insert_missing(self, model, rows):
+        """Insert rows in a batch. If another writer inserted any of them
+        first, reload the cache and insert what is still missing.
+
+        :param model: model of the rows
+        :type model: Model
+        :param rows: list of dicts of field values
+        :type rows: list
+        :returns: whether the cache was reloaded
+        :rtype: bool
+        """
+        if not rows:
+            return False
+
+        try:
+            with self.database.atomic():
+                model.insert_many(rows).execute()
+            return False
+
+        except IntegrityError:
+            self.load()
+            return True
+
+    def get_charge_category(self, category, text):
+        """Get or create a charge category.
+
+        :param category: category name
+        :type category: str
+        :param text: category text
+        :type text: str
+        :returns: charge category
+        :rtype: ChargeCategory
+        """
+        self.refresh()
+        if category not in self.charge_categories:
+            self.insert_missing(ChargeCategory,
+                                [{'category': category, 'text': text}])
+            self.charge_categories[category] = ChargeCategory.get(
+                ChargeCategory.category == category
+            )
+        return self.charge_categories[category]
+
+    def get_users(self, lines):
+        """Get or create users for lines.
+
+        :param lines: list of tuples of name and number
+        :type lines: list
+        :returns: dict of (name, number) to user
+        :rtype: dict
+        """
+        self.refresh()
+        # keep order of lines so that account holder gets the smallest id
+        missing = [line for line in lines if line not in self.users]
+        if missing and self.insert_missing(
+                User, [{'name': name, 'number': number}
+                       for (name, number) in missing]):
+            return self.get_users(lines)
+
+        if missing:
+            numbers = [number for (_, number) in missing]
+            for user in User.select().where(User.number << numbers):
+                self.users[(user.name, user.number)] = user
+        return {line: self.users[line] for line in lines}
+
+    def get_charge_types(self, charge_category, charge_types):
+        """Get or create charge types of a charge category.
+
+        :param charge_category: category of charge types
+        :type charge_category: ChargeCategory
+        :param charge_types: list of tuples of charge type and text
+        :type charge_types: list
+        :returns: dict of charge type to charge type object
+        :rtype: dict
+        """
+        self.refresh()
+        texts = dict(charge_types)
+        missing = [t for t in texts
+                   if (t, charge_category.id) not in self.charge_types]
+        if missing and self.insert_missing(
+                ChargeType, [{'type': t, 'text': texts[t],
+                              'charge_category': charge_category}
+                             for t in missing]):
+            return self.get_charge_types(charge_category, charge_types)
+
+        if missing:
+            for charge_type in ChargeType.select().where(
+                    ChargeType.charge_category == charge_category,
+                    ChargeType.type << missing):
+                key = (charge_type.type, charge_type.charge_category_id)
+                self.charge_types[key] = charge_type
+        return {t: self.charge_types[(t, charge_category.id)] for t in texts}
+
+
+_identity_map = IdentityMap()
+
+
+def get_identity_map():
+    """Get identity map of current process.
+
+    :returns: identity map
+    :rtype: IdentityMap
+    """
+    return _identity_map
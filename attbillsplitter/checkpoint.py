@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+"""Checkpoint of splitting bill history.
+
+Every billing cycle to split is recorded as pending for the account before
+bills are downloaded. A cycle is marked done in the same transaction that
+saves its charges, or failed with the error that stopped it, so that the
+cycles left can be resumed without crawling bill history again.
+"""
+
+from __future__ import unicode_literals
+import datetime as dt
+import peewee as pw
+from attbillsplitter.models import BackfillCycle, db
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def add_pending(account, bills):
+    """Record billing cycles to split as pending. Cycles already done are
+    left untouched, attempts of failed cycles are kept.
+
+    :param account: AT&T username
+    :type account: str
+    :param bills: list of tuples of billing cycle name and link to bill
+    :type bills: list
+    :returns: None
+    """
+    with db.atomic():
+        for bc_name, bill_link in bills:
+            cycle, created = BackfillCycle.get_or_create(
+                account=account, billing_cycle_name=bc_name,
+                defaults={'bill_link': bill_link}
+            )
+            if not created and cycle.status != DONE:
+                BackfillCycle.update(
+                    status=PENDING, bill_link=bill_link,
+                    updated_at=dt.datetime.utcnow()
+                ).where(BackfillCycle.id == cycle.id).execute()
+
+
+def mark_done(account, bc_name):
+    """Mark a billing cycle as split. Call it in the transaction saving the
+    bill so that both are committed together.
+
+    :param account: AT&T username
+    :type account: str
+    :param bc_name: billing cycle name
+    :type bc_name: str
+    :returns: None
+    """
+    BackfillCycle.update(
+        status=DONE, error=None, updated_at=dt.datetime.utcnow()
+    ).where(BackfillCycle.account == account,
+            BackfillCycle.billing_cycle_name == bc_name).execute()
+
+
+def mark_failed(account, bc_name, error):
+    """Mark a billing cycle as failed and count the attempt.
+
+    :param account: AT&T username
+    :type account: str
+    :param bc_name: billing cycle name
+    :type bc_name: str
+    :param error: error that stopped splitting the bill
+    :type error: Exception
+    :returns: None
+    """
+    BackfillCycle.update(
+        status=FAILED,
+        attempts=BackfillCycle.attempts + 1,
+        error='{}: {}'.format(type(error).__name__, error),
+        updated_at=dt.datetime.utcnow()
+    ).where(BackfillCycle.account == account,
+            BackfillCycle.billing_cycle_name == bc_name).execute()
+
+
+def get_unfinished(account):
+    """Get billing cycles of an account not split yet, in the order they
+    were recorded.
+
+    :param account: AT&T username
+    :type account: str
+    :returns: pending and failed billing cycles
+    :rtype: list
+    """
+    return list(
+        BackfillCycle
+        .select()
+        .where(BackfillCycle.account == account,
+               BackfillCycle.status != DONE)
+        .order_by(BackfillCycle.id)
+    )
+
+
+def get_progress(account):
+    """Count billing cycles of an account by status.
+
+    :param account: AT&T username
+    :type account: str
+    :returns: dict of status to number of billing cycles
+    :rtype: dict
+    """
+    progress = {PENDING: 0, DONE: 0, FAILED: 0}
+    query = (
+        BackfillCycle
+        .select(BackfillCycle.status, pw.fn.COUNT(BackfillCycle.id))
+        .where(BackfillCycle.account == account)
+        .group_by(BackfillCycle.status)
+        .tuples()
+    )
+    progress.update(query)
+    return progress
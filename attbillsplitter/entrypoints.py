@@ -10,6 +10,24 @@ def split_bill():
     run_split_bill()
 
 
+def resume_split():
+    """Split billing cycles left pending or failed by earlier runs."""
+    from attbillsplitter.main import run_resume_split
+    run_resume_split()
+
+
+def migrate_db():
+    """Apply pending schema migrations."""
+    from attbillsplitter.main import run_migrate_db
+    run_migrate_db()
+
+
+def archive():
+    """Archive charge details of old billing cycles."""
+    from attbillsplitter.archive import run_archive
+    run_archive()
+
+
 def print_summary():
     """Print wireless monthly summary among users."""
     from attbillsplitter.services import run_print_summary
@@ -22,12 +40,36 @@ def print_details():
     run_print_details()
 
 
+def render_statements():
+    """Render itemized statements of users to HTML and PDF files."""
+    from attbillsplitter.statements import run_render_statements
+    run_render_statements()
+
+
+def find_anomalies():
+    """Print unusual charges of users."""
+    from attbillsplitter.services import run_find_anomalies
+    run_find_anomalies()
+
+
+def serve_api():
+    """Serve bills as JSON over HTTP."""
+    from attbillsplitter.api import run_serve_api
+    run_serve_api()
+
+
 def notify_users():
     """Print wireless monthly details among users."""
     from attbillsplitter.services import run_notify_users
     run_notify_users()
 
 
+def notify_digest():
+    """Send users a single message for all billing cycles not notified."""
+    from attbillsplitter.services import run_notify_digest
+    run_notify_digest()
+
+
 def init_twilio():
     """Initialize twilio credentials."""
     from attbillsplitter.utils import initialize_twiolio
@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+"""Notification history log.
+
+Records are written as JSON Lines to a rotating file. Handlers run in a
+background thread fed by a queue, so logging never blocks sending messages.
+"""
+
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import datetime as dt
+import json
+import logging
+import logging.handlers
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import attbillsplitter.utils as utils
+
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# attributes of every LogRecord, anything else was passed with `extra`
+RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line."""
+
+    def format(self, record):
+        data = {
+            'time': dt.datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS:
+                data[key] = value
+        return json.dumps(data, sort_keys=True, default=str)
+
+
+@contextmanager
+def notification_log(logger, path=utils.LOG_PATH):
+    """Write records of logger to a rotating JSON Lines file while in the
+    context. Records are put on a queue and written by a background thread.
+
+    :param logger: logger of notifications
+    :type logger: logging.Logger
+    :param path: path to log file
+    :type path: str
+    """
+    file_handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
+    file_handler.setFormatter(JsonFormatter())
+    if hasattr(logging.handlers, 'QueueHandler'):
+        log_queue = queue.Queue(-1)
+        handler = logging.handlers.QueueHandler(log_queue)
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+    else:
+        # python 2 has no queue handler, write synchronously
+        handler = file_handler
+        listener = None
+    logger.addHandler(handler)
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        if listener:
+            # flush records left in queue
+            listener.stop()
+        file_handler.close()
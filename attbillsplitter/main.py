@@ -2,15 +2,27 @@
 """Main module"""
 
 from __future__ import print_function, unicode_literals
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import datetime as dt
 import re
+import threading
 import click
-import peewee as pw
 import requests
 from bs4 import BeautifulSoup, Tag
 from slugify import slugify
 # import fake_useragent
-from attbillsplitter.errors import ParsingError
+import attbillsplitter.checkpoint as checkpoint
+import attbillsplitter.metrics as metrics
+import attbillsplitter.utils as utils
+from attbillsplitter.cache import get_identity_map
+from attbillsplitter.errors import ConfigError, ParsingError
+from attbillsplitter.migrations import get_schema_version, migrate_database
+from attbillsplitter.reports import monthly_bill_query, wireless_totals_query
 from attbillsplitter.models import (
     User, ChargeCategory, ChargeType, BillingCycle, Charge, MonthlyBill, db
 )
@@ -19,6 +31,41 @@ from attbillsplitter.models import (
 CHROME_AGENT = ('Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 '
                 '(KHTML, like Gecko) Chrome/28.0.1468.0 Safari/537.36')
 # CHROME_AGENT = fake_useragent.UserAgent().chrome
+ACCOUNT_SHARE_TYPE = 'wireless-acount-monthly-charges-share'
+ACCOUNT_SHARE_TEXT = 'Account Monthly Charges Share'
+
+# plain records produced by parse_bill, picklable so that bills can be parsed
+# in worker processes
+ParsedBill = namedtuple(
+    'ParsedBill', ['bc_name', 'start_date', 'end_date', 'lines', 'charges']
+)
+ParsedCharge = namedtuple(
+    'ParsedCharge', ['name', 'number', 'charge_type', 'text', 'amount']
+)
+ChargeChanges = namedtuple('ChargeChanges', ['inserted', 'updated', 'deleted'])
+
+BILLS_FETCHED = metrics.counter('bills_fetched_total',
+                                'Bills downloaded from AT&T.')
+BILLS_SKIPPED = metrics.counter(
+    'bills_skipped_total', 'Bills skipped as already processed or archived.'
+)
+BILLS_SPLIT = metrics.counter('bills_split_total',
+                              'Bills split or re-split and saved.')
+BILLS_FAILED = metrics.counter(
+    'bills_failed_total', 'Bills failed to download, parse or save.'
+)
+HTTP_RESPONSE_BYTES = metrics.counter('http_response_bytes_total',
+                                      'Bytes downloaded from AT&T.')
+HTTP_REQUEST_SECONDS = metrics.histogram('http_request_duration_seconds',
+                                         'Latency of requests to AT&T.')
+PARSE_SECONDS = metrics.histogram('bill_parse_duration_seconds',
+                                  'Time spent parsing a bill.')
+WRITE_SECONDS = metrics.histogram('bill_write_duration_seconds',
+                                  'Time spent saving a billing cycle.')
+WRITE_STATEMENTS = metrics.histogram(
+    'bill_write_statements', 'SQL statements run to save a billing cycle.',
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+)
 
 
 def create_tables_if_not_exist():
@@ -31,12 +78,15 @@ def create_tables_if_not_exist():
         - BillingCycle
         - Charge
         - MonthlyBill
+
+    Pending schema migrations are applied afterwards.
     """
     db.connect()
     for model in (User, ChargeCategory, ChargeType, BillingCycle, Charge,
                   MonthlyBill):
         if not model.table_exists():
             model.create_table()
+    migrate_database()
 
 
 def get_start_end_date(bc_name):
@@ -57,33 +107,319 @@ def get_start_end_date(bc_name):
 
 
 def aggregate_wireless_monthly(bc):
-    """Aggregate wireless charges among all lines.
+    """Aggregate wireless charges among all lines. Monthly bills already
+    saved are updated or deleted to match charges of the billing cycle.
 
     :param bc: billing_cycle object
     :type bc: BillingCycle
     :returns: None
     """
-    if MonthlyBill.select().where(MonthlyBill.billing_cycle == bc).exists():
-        print('\U000026A0  Charges already aggregated for {}'.format(bc.name))
-        return
-
-    query = (
-        User
-        .select(User,
-                pw.fn.SUM(Charge.amount).alias('total'))
-        .join(Charge)
-        .join(BillingCycle)
-        .switch(Charge)
-        .join(ChargeType)
-        .join(ChargeCategory)
-        .where(BillingCycle.id == bc.id,
-               ChargeCategory.category == 'wireless')
-        .group_by(User, BillingCycle)
-        .naive()
+    totals = dict(wireless_totals_query(bc.id).execute())
+    existing = {
+        user_id: (mb_id, total)
+        for (mb_id, user_id, total) in monthly_bill_query(bc.id).select(
+            MonthlyBill.id, MonthlyBill.user, MonthlyBill.total
+        ).tuples().execute()
+    }
+    rows = [{'user': user_id, 'billing_cycle': bc, 'total': total}
+            for (user_id, total) in totals.items() if user_id not in existing]
+    insert_rows(MonthlyBill, rows)
+    for user_id, (mb_id, total) in existing.items():
+        if user_id not in totals:
+            MonthlyBill.delete().where(MonthlyBill.id == mb_id).execute()
+        elif not amount_equal(total, totals[user_id]):
+            MonthlyBill.update(total=totals[user_id]).where(
+                MonthlyBill.id == mb_id
+            ).execute()
+
+
+def amount_equal(a, b):
+    """Compare two amounts parsed from bills.
+
+    :returns: whether a and b are the same amount
+    :rtype: bool
+    """
+    return abs(a - b) < 1e-6
+
+
+def insert_rows(model, rows, batch_size=100):
+    """Insert rows in batches to stay below the limit of SQLite on number
+    of variables in a statement.
+
+    :param model: model of the rows
+    :type model: Model
+    :param rows: list of dicts of field values
+    :type rows: list
+    :returns: None
+    """
+    for i in range(0, len(rows), batch_size):
+        model.insert_many(rows[i:i + batch_size]).execute()
+
+
+def parse_lines(soup):
+    """Parse the bill to find name and number for each line. Account holder
+    should be the first entry.
+
+    :param soup: parsed bill
+    :type soup: BeautifulSoup
+    :returns: list of tuples of name and number
+    :rtype: list
+    """
+    lines = []
+    number_tags = soup.find_all('div', string=re.compile('Total for'))
+    for num_tag in number_tags:
+        number = num_tag.text.lstrip('Total for')
+        # get name for number
+        name_tag = soup.find('div', class_='accRow bold MarTop10',
+                             string=re.compile('{}'.format(number)))
+        name = name_tag.text.rstrip(' {}'.format(number))
+        lines.append((name, number))
+    return lines
+
+
+def parse_line_charges(soup, name, number):
+    """Parse charges of one line.
+
+    :param soup: parsed bill
+    :type soup: BeautifulSoup
+    :param name: name of the line
+    :type name: str
+    :param number: number of the line
+    :type number: str
+    :yields: tuple of charge type text and the tag of the charge section
+    """
+    # charge section starts with user name followed by his/her number
+    target = soup.find('div', string=re.compile('{} {}'.format(name, number)))
+    for tag in target.parent.next_siblings:
+        # all charge data are in divs
+        if not isinstance(tag, Tag) or tag.name != 'div':
+            continue
+
+        # charge section ends with Total for number
+        if 'Total for {}'.format(number) in tag.text:
+            break
+
+        # each charge type has 'accSummary' as one of its css classes
+        if 'accSummary' in tag.get('class', []):
+            charge_type_text = tag.find('div').text.strip('\n\t')
+            if charge_type_text.startswith('Monthly Charges'):
+                charge_type_text = 'Monthly Charges'
+            yield charge_type_text, tag
+
+
+def parse_charge_total(charge_type_text, tag):
+    """Get the total of a charge section.
+
+    :param charge_type_text: charge type text
+    :type charge_type_text: str
+    :param tag: tag of the charge section
+    :type tag: Tag
+    :returns: total of the charge type
+    :rtype: float
+    """
+    m = re.search(
+        r'Total {}.*?\$([0-9.]+)'.format(charge_type_text),
+        tag.text,
+        flags=re.DOTALL
     )
-    results = query.execute()
-    for user in results:
-        MonthlyBill.create(user=user, billing_cycle=bc, total=user.total)
+    return float(m.group(1))
+
+
+def parse_bill(bc_name, bill_html):
+    """Parse bill and split wireless charges among lines.
+
+    This function does not touch the database so that it can run in a
+    separate process. Currently not parsing U-Verse charges.
+    :param bc_name: billing cycle name
+    :type bc_name: str
+    :param bill_html: html of the bill
+    :type bill_html: str
+    :returns: parsed bill
+    :rtype: ParsedBill
+    """
+    if 'Account Details' not in bill_html:
+        raise ParsingError('Failed to retrieve billing page')
+
+    soup = BeautifulSoup(bill_html, 'html.parser')
+    start_date, end_date = get_start_end_date(bc_name)
+    # parse user name and number
+    lines = parse_lines(soup)
+    charges = []
+    if not lines:
+        return ParsedBill(bc_name, start_date, end_date, lines, charges)
+
+    # --------------------------------------------------------------------
+    # Wireless
+    # --------------------------------------------------------------------
+    charged_lines = lines[:1]
+    name, number = lines[0]
+    for charge_type_text, tag in parse_line_charges(soup, name, number):
+        offset = 0.0
+        if charge_type_text == 'Monthly Charges':
+            # account monthly fee will be shared by all users
+            w_act_m = float(re.search(r'\$([0-9.]+)', tag.text).group(1))
+            # national discount is applied to account monthly fee
+            m = re.search(r'National Account Discount.*?\$([0-9.]+)',
+                          tag.text, re.DOTALL)
+            w_act_m_disc = float(m.group(1)) if m else 0.0
+            # this non-zero offset will be used to adjust account holder's
+            # total monthly charge
+            offset = w_act_m - w_act_m_disc
+
+        charge_total = parse_charge_total(charge_type_text, tag) - offset
+        charges.append(ParsedCharge(name, number, slugify(charge_type_text),
+                                    charge_type_text, charge_total))
+
+    # iterate regular users
+    for name, number in lines[1:]:
+        charge_total = 0.0
+        for charge_type_text, tag in parse_line_charges(soup, name, number):
+            charge_total = parse_charge_total(charge_type_text, tag)
+            charges.append(ParsedCharge(name, number,
+                                        slugify(charge_type_text),
+                                        charge_type_text, charge_total))
+        if charge_total > 0:
+            charged_lines.append((name, number))
+
+    # share of account monthly charges for each user
+    act_m_share = (w_act_m - w_act_m_disc) / len(charged_lines)
+    for name, number in charged_lines:
+        charges.append(ParsedCharge(name, number, ACCOUNT_SHARE_TYPE,
+                                    ACCOUNT_SHARE_TEXT, act_m_share))
+    return ParsedBill(bc_name, start_date, end_date, lines, charges)
+
+
+def save_bill(parsed_bill):
+    """Save a parsed bill to database in a single transaction.
+
+    :param parsed_bill: bill returned by `parse_bill`
+    :type parsed_bill: ParsedBill
+    :returns: billing cycle created
+    :rtype: BillingCycle
+    """
+    billing_cycle, _ = write_bill(parsed_bill, resplit=False)
+    return billing_cycle
+
+
+def resplit_bill(parsed_bill):
+    """Save a bill parsed again for a billing cycle already in database.
+
+    Parsed charges are compared with charges saved for the billing cycle.
+    Only the differences are written, in a single transaction, and monthly
+    bills are refreshed.
+    :param parsed_bill: bill returned by `parse_bill`
+    :type parsed_bill: ParsedBill
+    :returns: number of charges inserted, updated and deleted
+    :rtype: ChargeChanges
+    """
+    _, changes = write_bill(parsed_bill, resplit=True)
+    return changes
+
+
+def write_bill(parsed_bill, resplit):
+    """Create or look up billing cycle of a parsed bill and sync its charges
+    in a single transaction.
+
+    :param parsed_bill: bill returned by `parse_bill`
+    :type parsed_bill: ParsedBill
+    :param resplit: whether billing cycle already exists
+    :type resplit: bool
+    :returns: tuple of billing cycle and changes of charges
+    :rtype: tuple
+    """
+    identity_map = get_identity_map()
+    try:
+        with db.atomic():
+            if resplit:
+                billing_cycle = BillingCycle.get(
+                    BillingCycle.name == parsed_bill.bc_name
+                )
+            else:
+                billing_cycle = BillingCycle.create(
+                    name=parsed_bill.bc_name,
+                    start_date=parsed_bill.start_date,
+                    end_date=parsed_bill.end_date,
+                    updated_at=dt.datetime.utcnow()
+                )
+            changes = sync_charges(billing_cycle, parsed_bill, identity_map)
+            if resplit and any(changes):
+                BillingCycle.update(updated_at=dt.datetime.utcnow()).where(
+                    BillingCycle.id == billing_cycle.id
+                ).execute()
+            # aggregate
+            aggregate_wireless_monthly(billing_cycle)
+        return billing_cycle, changes
+
+    except Exception:
+        # rows cached during a rolled back transaction do not exist
+        identity_map.invalidate()
+        raise
+
+
+def sync_charges(billing_cycle, parsed_bill, identity_map):
+    """Insert, update and delete charges of billing cycle so that they match
+    charges of the parsed bill.
+
+    :param billing_cycle: billing cycle of the bill
+    :type billing_cycle: BillingCycle
+    :param parsed_bill: bill returned by `parse_bill`
+    :type parsed_bill: ParsedBill
+    :param identity_map: cache of users and charge types
+    :type identity_map: IdentityMap
+    :returns: number of charges inserted, updated and deleted
+    :rtype: ChargeChanges
+    """
+    amounts = {}
+    if parsed_bill.lines:
+        wireless_charge_category = identity_map.get_charge_category(
+            'wireless', 'Wireless'
+        )
+        users = identity_map.get_users(parsed_bill.lines)
+        charge_types = identity_map.get_charge_types(
+            wireless_charge_category,
+            [(c.charge_type, c.text) for c in parsed_bill.charges]
+        )
+        for charge in parsed_bill.charges:
+            key = (users[(charge.name, charge.number)].id,
+                   charge_types[charge.charge_type].id)
+            amounts[key] = amounts.get(key, 0.0) + charge.amount
+
+    existing = {
+        (user_id, charge_type_id): (charge_id, amount)
+        for (charge_id, user_id, charge_type_id, amount) in (
+            Charge
+            .select(Charge.id, Charge.user, Charge.charge_type, Charge.amount)
+            .where(Charge.billing_cycle == billing_cycle)
+            .tuples()
+            .execute()
+        )
+    }
+    rows = [{'user': user_id,
+             'charge_type': charge_type_id,
+             'billing_cycle': billing_cycle,
+             'amount': amount}
+            for (user_id, charge_type_id), amount in amounts.items()
+            if (user_id, charge_type_id) not in existing]
+    insert_rows(Charge, rows)
+    updated = 0
+    deleted = []
+    for key, (charge_id, amount) in existing.items():
+        if key not in amounts:
+            deleted.append(charge_id)
+        elif not amount_equal(amount, amounts[key]):
+            Charge.update(amount=amounts[key]).where(
+                Charge.id == charge_id
+            ).execute()
+            updated += 1
+    if deleted:
+        Charge.delete().where(Charge.id << deleted).execute()
+    return ChargeChanges(len(rows), updated, len(deleted))
+
+
+def record_response(response, *args, **kwargs):
+    """Response hook of requests session recording latency and size."""
+    HTTP_REQUEST_SECONDS.observe(response.elapsed.total_seconds())
+    HTTP_RESPONSE_BYTES.inc(len(response.content))
 
 
 class AttBillSplitter(object):
@@ -96,9 +432,20 @@ class AttBillSplitter(object):
     def __init__(self, username, password):
         self.username = username
         self.password = password
-        self.session = requests.session()
+        self.session = self.new_session()
+
+    def new_session(self):
+        """Create a requests session sharing cookies of the current one.
+
+        :rtype: requests.Session
+        """
+        session = requests.session()
         headers = {'User-Agent': CHROME_AGENT}
-        self.session.headers.update(headers)
+        session.headers.update(headers)
+        session.hooks['response'].append(record_response)
+        if getattr(self, 'session', None) is not None:
+            session.cookies.update(self.session.cookies)
+        return session
 
     def login(self):
         """Login to your AT&T online account.
@@ -195,26 +542,21 @@ class AttBillSplitter(object):
             bill_link = bill_link_template.format(end_date_str, act_num)
             yield (bc_name, bill_link)
 
-    def parse_user_info(self, bill_html):
-        """Parse the bill to find name and number for each line and create
-        users. Account holder should be the first entry.
+    def fetch_bill(self, bill_link, session=None):
+        """Download the html of a bill.
 
-        :returns: list of user objects
-        :rtype: list
-        :returns: None
+        :param bill_link: url to bill
+        :type bill_link: str
+        :param session: logged-in session. Default to session of splitter
+        :type session: requests.Session
+        :returns: html of the bill
+        :rtype: str
         """
-        users = []
-        soup = BeautifulSoup(bill_html, 'html.parser')
-        number_tags = soup.find_all('div', string=re.compile('Total for'))
-        for num_tag in number_tags:
-            number = num_tag.text.lstrip('Total for')
-            # get name for number
-            name_tag = soup.find('div', class_='accRow bold MarTop10',
-                                 string=re.compile('{}'.format(number)))
-            name = name_tag.text.rstrip(' {}'.format(number))
-            user, _ = User.get_or_create(name=name, number=number)
-            users.append(user)
-        return users
+        session = session or self.session
+        bill_req = session.get(bill_link)
+        bill_req.raise_for_status()
+        BILLS_FETCHED.inc()
+        return bill_req.text
 
     def split_bill(self, bc_name, bill_link):
         """Parse bill and split wireless charges among users.
@@ -226,208 +568,355 @@ class AttBillSplitter(object):
         :type bc_name: str
         :returns: None
         """
-        bill_req = self.session.get(bill_link)
-        bill_html = bill_req.text
-        if 'Account Details' not in bill_html:
-            raise ParsingError('Failed to retrieve billing page')
-
-        soup = BeautifulSoup(bill_html, 'html.parser')
-        start_date, end_date = get_start_end_date(bc_name)
-        billing_cycle = BillingCycle.create(name=bc_name,
-                                            start_date=start_date,
-                                            end_date=end_date)
-
-        # parse user name and number
-        users = self.parse_user_info(bill_html)
-        if not users:
+        parsed_bill = parse_bill(bc_name, self.fetch_bill(bill_link))
+        save_bill(parsed_bill)
+        BILLS_SPLIT.inc()
+
+    def fetch_bills(self, bills, jobs=1):
+        """Download bills, several at a time with more than one job.
+
+        A bill that cannot be downloaded does not stop the others. Sessions
+        are not thread safe, so each download thread gets its own copy of
+        the logged-in session.
+        :param bills: list of tuples of billing cycle name and link to bill
+        :type bills: list
+        :param jobs: number of concurrent downloads
+        :type jobs: int
+        :yields: tuples of billing cycle name, html of the bill and error,
+            in order of bills
+        """
+        local = threading.local()
+        sessions = []
+
+        def fetch(bill):
+            bc_name, bill_link = bill
+            session = None
+            if jobs > 1:
+                session = getattr(local, 'session', None)
+                if session is None:
+                    session = local.session = self.new_session()
+                    sessions.append(session)
+            try:
+                return bc_name, self.fetch_bill(bill_link, session), None
+            except requests.RequestException as e:
+                return bc_name, None, e
+
+        if jobs <= 1:
+            for bill in bills:
+                yield fetch(bill)
             return
 
-        account_holder = users[0]
-        # --------------------------------------------------------------------
-        # Wireless
-        # --------------------------------------------------------------------
-        wireless_charge_category, _ = ChargeCategory.get_or_create(
-            category='wireless',
-            text='Wireless'
-        )
-        charged_users = users[:1]
-        name, number = account_holder.name, account_holder.number
-        offset = 0.0
-        # charge section starts with user name followed by his/her number
-        target = soup.find('div',
-                           string=re.compile('{} {}'.format(name, number)))
-        for tag in target.parent.next_siblings:
-            # all charge data are in divs
-            if not isinstance(tag, Tag) or tag.name != 'div':
-                continue
-
-            # charge section ends with Total for number
-            if 'Total for {}'.format(number) in tag.text:
-                break
-
-            # each charge type has 'accSummary' as one of its css classes
-            if 'accSummary' in tag.get('class', []):
-                charge_type_text = tag.find('div').text.strip('\n\t')
-                if charge_type_text.startswith('Monthly Charges'):
-                    charge_type_text = 'Monthly Charges'
-                    # account monthly fee will be shared by all users
-                    w_act_m = float(
-                        re.search(r'\$([0-9.]+)', tag.text).group(1)
-                    )
-                    # national discount is applied to account monthly fee
-                    m = re.search(
-                        r'National Account Discount.*?\$([0-9.]+)',
-                        tag.text, re.DOTALL
-                    )
-                    w_act_m_disc = float(m.group(1)) if m else 0.0
-                    # this non-zero offset will be used to adjust account
-                    # holder's total monthly charge
-                    offset = w_act_m - w_act_m_disc
-
-                m = re.search(
-                    r'Total {}.*?\$([0-9.]+)'.format(charge_type_text),
-                    tag.text,
-                    flags=re.DOTALL
-                )
-                charge_total = float(m.group(1)) - offset
-                # save data to db
-                charge_type_name = slugify(charge_type_text)
-                # ChargeType
-                charge_type, _ = ChargeType.get_or_create(
-                    type=charge_type_name,
-                    text=charge_type_text,
-                    charge_category=wireless_charge_category
-                )
-                # Charge
-                new_charge = Charge(
-                    user=account_holder,
-                    charge_type=charge_type,
-                    billing_cycle=billing_cycle,
-                    amount=charge_total
-                )
-                new_charge.save()
-                offset = 0.0
-
-        # iterate regular users
-        for user in users[1:]:
-            charge_total = 0.0
-            name, number = user.name, user.number
-            # charge section starts with user name followed by his/her number
-            target = soup.find('div',
-                               string=re.compile('{} {}'.format(name, number)))
-            for tag in target.parent.next_siblings:
-                # all charge data are in divs
-                if not isinstance(tag, Tag) or tag.name != 'div':
-                    continue
-
-                # charge section ends with Total for number
-                if 'Total for {}'.format(number) in tag.text:
-                    break
-
-                # each charge type has 'accSummary' as one of its css classes
-                if 'accSummary' in tag.get('class', []):
-                    charge_type_text = tag.find('div').text.strip('\n\t')
-                    if charge_type_text.startswith('Monthly Charges'):
-                        charge_type_text = 'Monthly Charges'
-
-                    m = re.search(
-                        r'Total {}.*?\$([0-9.]+)'.format(charge_type_text),
-                        tag.text,
-                        flags=re.DOTALL
-                    )
-                    charge_total = float(m.group(1))
-                    # save data to db
-                    charge_type_name = slugify(charge_type_text)
-                    # ChargeType
-                    charge_type, _ = ChargeType.get_or_create(
-                        type=charge_type_name,
-                        text=charge_type_text,
-                        charge_category=wireless_charge_category
-                    )
-                    # Charge
-                    new_charge = Charge(
-                        user=user,
-                        charge_type=charge_type,
-                        billing_cycle=billing_cycle,
-                        amount=charge_total
-                    )
-                    new_charge.save()
-            if charge_total > 0:
-                charged_users.append(user)
-
-        # update share of account monthly charges for each user
-        # also calculate total wireless charges (for verification later)
-        act_m_share = (w_act_m - w_act_m_disc) / len(charged_users)
-        wireless_total = 0
-        for user in charged_users:
-            # ChargeType
-            charge_type, _ = ChargeType.get_or_create(
-                type='wireless-acount-monthly-charges-share',
-                text='Account Monthly Charges Share',
-                charge_category=wireless_charge_category
-            )
-            # Charge
-            new_charge = Charge(
-                user=user,
-                charge_type=charge_type,
-                billing_cycle=billing_cycle,
-                amount=act_m_share
-            )
-            new_charge.save()
-            user_total = Charge.select(
-                pw.fn.Sum(Charge.amount).alias('total')
-            ).join(
-                ChargeType,
-                on=Charge.charge_type_id == ChargeType.id
-            ).where(
-                (Charge.user == user),
-                Charge.billing_cycle == billing_cycle,
-                ChargeType.charge_category == wireless_charge_category
-            )
-            wireless_total += user_total[0].total
-
-        # aggregate
-        aggregate_wireless_monthly(billing_cycle)
-
-    def run(self, lag, force):
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for result in executor.map(fetch, bills):
+                    yield result
+        finally:
+            for session in sessions:
+                session.close()
+
+    def split_bills(self, bills, jobs=None, resplit=(), fetch_jobs=1):
+        """Parse bills in a process pool and save them to database.
+
+        Bills are downloaded with the logged-in session and parsed in
+        parallel. A single writer thread saves parsed bills in the order
+        they are given, so database writes never happen concurrently. Each
+        bill is saved and marked done in the checkpoint in one transaction.
+        A bill that cannot be downloaded, parsed or saved is marked failed
+        and the others are still split.
+        :param bills: list of tuples of billing cycle name and link to bill
+        :type bills: list
+        :param jobs: number of parsing processes. Default to number of CPUs
+        :type jobs: int
+        :param resplit: names of billing cycles already in database, whose
+            charges will be updated with `resplit_bill`
+        :type resplit: set
+        :param fetch_jobs: number of concurrent downloads
+        :type fetch_jobs: int
+        :returns: names of billing cycles failed
+        :rtype: list
+        """
+        parsed_queue = queue.Queue()
+        errors = []
+        failed = []
+
+        def write_one(bc_name, future):
+            parsed_bill, parse_seconds = future.result()
+            PARSE_SECONDS.observe(parse_seconds)
+            with WRITE_SECONDS.time(), metrics.count_statements(
+                    db, WRITE_STATEMENTS):
+                with db.atomic():
+                    if bc_name in resplit:
+                        changes = resplit_bill(parsed_bill)
+                    else:
+                        save_bill(parsed_bill)
+                    checkpoint.mark_done(self.username, bc_name)
+            BILLS_SPLIT.inc()
+            if bc_name in resplit:
+                print('\U0001F3C1  Finished re-splitting bill {}: '
+                      '{} inserted, {} updated, {} deleted.'.format(
+                          bc_name, *changes))
+            else:
+                print('\U0001F3C1  Finished splitting bill '
+                      '{}.'.format(bc_name))
+
+        def write():
+            try:
+                while True:
+                    item = parsed_queue.get()
+                    if item is None:
+                        return
+
+                    bc_name, future = item
+                    try:
+                        write_one(bc_name, future)
+                    except Exception as e:
+                        get_identity_map().invalidate()
+                        BILLS_FAILED.inc()
+                        failed.append(bc_name)
+                        checkpoint.mark_failed(self.username, bc_name, e)
+                        print('\U0001F6AB  Failed splitting bill {}: '
+                              '{}'.format(bc_name, e))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if not db.is_closed():
+                    db.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                for bc_name, bill_html, error in self.fetch_bills(
+                        bills, fetch_jobs):
+                    if errors:
+                        break
+
+                    print('\U0001F3C3  Start splitting bill '
+                          '{}...'.format(bc_name))
+                    if error:
+                        future = Future()
+                        future.set_exception(error)
+                    else:
+                        future = executor.submit(metrics.timed, parse_bill,
+                                                 bc_name, bill_html)
+                    parsed_queue.put((bc_name, future))
+        finally:
+            parsed_queue.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+
+        return failed
+
+    def run(self, lag, force, jobs=None, resplit=False):
         """
         :param lag: a list of lags indicating which bills to split
         :type lag: list
         :param force: a flag to force splitting the bill
         :type force: bool
+        :param jobs: number of parsing processes. Default to number of CPUs
+        :type jobs: int
+        :param resplit: a flag to parse bills already processed again and
+            update their charges
+        :type resplit: bool
         :returns: None
         """
         if not self.login():
             return
 
+        bills = []
+        resplit_names = set()
         for i, (bc_name, bill_link) in enumerate(self.get_history_bills()):
             # if lag is not empty, only split bills specified
             if lag and (i not in lag) and not force:
                 continue
 
             # check if billing cycle already exist
-            if BillingCycle.select().where(
-                    BillingCycle.name == bc_name
-            ):
+            bc = BillingCycle.select().where(
+                BillingCycle.name == bc_name
+            ).first()
+            if bc and bc.archived_at:
+                BILLS_SKIPPED.inc()
+                print('\U000026A0  Billing Cycle {} already '
+                      'archived.'.format(bc_name))
+                continue
+
+            if bc and not resplit:
+                BILLS_SKIPPED.inc()
                 print('\U000026A0  Billing Cycle {} already '
                       'processed.'.format(bc_name))
                 continue
 
-            print('\U0001F3C3  Start splitting bill {}...'.format(bc_name))
-            self.split_bill(bc_name, bill_link)
-            print('\U0001F3C1  Finished splitting bill {}.'.format(bc_name))
+            if bc:
+                resplit_names.add(bc_name)
+            bills.append((bc_name, bill_link))
+        checkpoint.add_pending(self.username, bills)
+        self.split_bills(bills, jobs, resplit_names)
+        self.print_progress()
+
+    def resume(self, jobs=None, retry_jobs=4, max_attempts=3):
+        """Split billing cycles left pending or failed by earlier runs,
+        without crawling bill history again. Failed cycles are downloaded
+        again several at a time.
+
+        :param jobs: number of parsing processes. Default to number of CPUs
+        :type jobs: int
+        :param retry_jobs: number of concurrent downloads of failed bills
+        :type retry_jobs: int
+        :param max_attempts: number of attempts after which a failed
+            billing cycle is no longer retried
+        :type max_attempts: int
+        :returns: None
+        """
+        cycles = checkpoint.get_unfinished(self.username)
+        if not cycles:
+            print('\U00002705  No billing cycle left to split.')
+            return
+
+        if not self.login():
+            return
+
+        pending = []
+        failed = []
+        for cycle in cycles:
+            bill = (cycle.billing_cycle_name, cycle.bill_link)
+            if cycle.status == checkpoint.PENDING:
+                pending.append(bill)
+            elif cycle.attempts < max_attempts:
+                failed.append(bill)
+            else:
+                print('\U000026A0  Billing Cycle {} failed {} times: '
+                      '{}'.format(cycle.billing_cycle_name, cycle.attempts,
+                                  cycle.error))
+        # cycles queued by a re-split run are in database already
+        names = [bc_name for bc_name, _ in pending + failed]
+        resplit_names = set()
+        if names:
+            resplit_names.update(
+                name for (name,) in BillingCycle
+                .select(BillingCycle.name)
+                .where(BillingCycle.name << names)
+                .tuples()
+            )
+        self.split_bills(pending, jobs, resplit_names)
+        self.split_bills(failed, jobs, resplit_names, fetch_jobs=retry_jobs)
+        self.print_progress()
+
+    def print_progress(self):
+        """Print number of billing cycles of the account by status.
+
+        :returns: None
+        """
+        progress = checkpoint.get_progress(self.username)
+        print('\U0001F4CB  Billing cycles: {done} done, {failed} failed, '
+              '{pending} pending.'.format(**progress))
+        if progress[checkpoint.FAILED] or progress[checkpoint.PENDING]:
+            print('\U000027A1  Run att-resume-split to retry the rest.')
+
+
+def get_credentials(username=None, password=None):
+    """Get AT&T username and password from CLI options, environment
+    variables or config file. Prompt for missing ones unless in
+    non-interactive mode.
+
+    :param username: username from CLI option
+    :type username: str
+    :param password: password from CLI option
+    :type password: str
+    :returns: tuple of username and password
+    :rtype: tuple
+    """
+    utils.set_config_override('att', 'username', username)
+    utils.set_config_override('att', 'password', password)
+    try:
+        username = utils.require_config_value('att', 'username',
+                                              '\U0001F464  AT&T Username')
+        password = utils.require_config_value('att', 'password',
+                                              '\U0001F5DD  AT&T Password',
+                                              hide_input=True)
+    except ConfigError as e:
+        raise click.ClickException(str(e))
+
+    return username, password
+
+
+def account_options(func):
+    """Add options of commands logging in to AT&T: credentials,
+    non-interactive mode and metrics path.
+    """
+    options = [
+        click.option('--username', help='AT&T username. Default to '
+                     'ATTBS_ATT_USERNAME or username in [att] section of '
+                     'config.'),
+        click.option('--password', help='AT&T password. Default to '
+                     'ATTBS_ATT_PASSWORD or password in [att] section of '
+                     'config.'),
+        click.option('--non-interactive', is_flag=True,
+                     help='Never prompt, fail if username or password is '
+                     'missing.'),
+        metrics.metrics_option,
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def get_splitter(username, password, non_interactive, metrics_path):
+    """Apply options added by `account_options` and create a bill splitter.
+
+    :returns: tuple of bill splitter and metrics path
+    :rtype: tuple
+    """
+    if non_interactive:
+        utils.set_non_interactive()
+    utils.set_config_override('metrics', 'path', metrics_path)
+    username, password = get_credentials(username, password)
+    create_tables_if_not_exist()
+    return (AttBillSplitter(username, password),
+            utils.get_config_value('metrics', 'path'))
 
 
 @click.command()
 @click.option('--lag', '-l', multiple=True, type=int)
 @click.option('--force', '-f', default=False)
-@click.option('--username', prompt='\U0001F464  AT&T Username')
-@click.option('--password', prompt='\U0001F5DD  AT&T Password',
-              hide_input=True)
-def run_split_bill(username, password, lag, force):
+@click.option('--jobs', '-j', type=int,
+              help='Number of processes used to parse bills.')
+@click.option('--resplit', '-r', is_flag=True,
+              help='Parse bills already processed again and apply changes.')
+@account_options
+def run_split_bill(username, password, lag, force, jobs, resplit,
+                   non_interactive, metrics_path):
+    splitter, metrics_path = get_splitter(username, password,
+                                          non_interactive, metrics_path)
+    with metrics.run_metrics('split', metrics_path):
+        splitter.run(lag, force, jobs, resplit)
+
+
+@click.command()
+@click.option('--jobs', '-j', type=int,
+              help='Number of processes used to parse bills.')
+@click.option('--retry-jobs', type=int, default=4, show_default=True,
+              help='Number of failed bills downloaded at a time.')
+@click.option('--max-attempts', type=int, default=3, show_default=True,
+              help='Stop retrying a bill after this many failures.')
+@account_options
+def run_resume_split(jobs, retry_jobs, max_attempts, username, password,
+                     non_interactive, metrics_path):
+    """Split billing cycles left pending or failed by earlier att-split-bill
+    runs, without crawling bill history again.
+    """
+    splitter, metrics_path = get_splitter(username, password,
+                                          non_interactive, metrics_path)
+    with metrics.run_metrics('resume', metrics_path):
+        splitter.resume(jobs, retry_jobs, max_attempts)
+
+
+@click.command()
+def run_migrate_db():
+    """Create missing tables and apply pending schema migrations."""
     create_tables_if_not_exist()
-    splitter = AttBillSplitter(username, password)
-    splitter.run(lag, force)
+    print('\U00002705  Database schema is at version '
+          '{}.'.format(get_schema_version()))
 
 
 if __name__ == '__main__':
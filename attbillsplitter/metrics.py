@@ -0,0 +1,427 @@
+# -*- coding:utf-8 -*-
+"""Run metrics of bill splitting and notifications.
+
+Counters, gauges and histograms are registered at import time by the modules
+that update them and collected in a process wide registry. After a run, the
+registry is written as a Prometheus textfile (for the node exporter textfile
+collector) or as a JSON snapshot, so throughput and AT&T response times can
+be tracked and alerted on over time.
+"""
+
+from __future__ import division, unicode_literals
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
+import json
+import math
+import os
+import re
+import threading
+import time
+import click
+
+PREFIX = 'attbs_'
+# seconds, from fast SQL writes up to slow AT&T pages
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+class Metric(object):
+    """Base of all metrics, a single value. Updates are thread safe."""
+
+    type = 'untyped'
+
+    def __init__(self, name, documentation):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Get samples in Prometheus exposition order.
+
+        :returns: list of tuples of sample name, labels and value
+        :rtype: list
+        """
+        return [(self.name, '', self.value)]
+
+    def snapshot(self):
+        """Get current value for JSON export."""
+        return self.value
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Metric):
+    """A value that is set to the latest observation."""
+
+    type = 'gauge'
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe seconds spent in the context."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    def samples(self):
+        samples = [
+            (self.name + '_bucket', 'le="{}"'.format(format_value(bound)),
+             count)
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        samples.append((self.name + '_bucket', 'le="+Inf"', self.count))
+        samples.append((self.name + '_sum', '', self.sum))
+        samples.append((self.name + '_count', '', self.count))
+        return samples
+
+    def snapshot(self):
+        buckets = OrderedDict(
+            (format_value(bound), count)
+            for bound, count in zip(self.buckets, self.counts)
+        )
+        buckets['+Inf'] = self.count
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class Registry(object):
+    """Metrics of this process, by name."""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        """Register a metric, or get the one registered with its name.
+
+        :param metric: metric
+        :type metric: Metric
+        :returns: registered metric
+        :rtype: Metric
+        """
+        return self.metrics.setdefault(metric.name, metric)
+
+    def to_text(self, command=None, content=None):
+        """Render metrics in Prometheus text exposition format.
+
+        :param command: name of command labelling every sample
+        :type command: str
+        :param content: metrics file written by other commands, whose
+            samples are kept
+        :type content: str
+        :rtype: str
+        """
+        families = parse_families(content or '')
+        for family in families.values():
+            family['samples'] = [
+                line for line in family['samples']
+                if sample_command(line) not in (None, command)
+            ]
+        extra = 'command="{}"'.format(command) if command else ''
+        for metric in self.metrics.values():
+            family = families.setdefault(metric.name, {'samples': []})
+            family['help'] = metric.documentation
+            family['type'] = metric.type
+            for name, labels, value in metric.samples():
+                labels = ','.join(label for label in (extra, labels)
+                                  if label)
+                if labels:
+                    name = '{}{{{}}}'.format(name, labels)
+                family['samples'].append(
+                    '{} {}'.format(name, format_value(value))
+                )
+
+        lines = []
+        for name, family in families.items():
+            if not family['samples']:
+                continue
+
+            lines.append('# HELP {} {}'.format(name, family['help']))
+            lines.append('# TYPE {} {}'.format(name, family['type']))
+            lines.extend(family['samples'])
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self, command=None, content=None):
+        """Render metrics as a JSON snapshot.
+
+        :param command: name of command the snapshot is nested under
+        :type command: str
+        :param content: metrics file written by other commands, whose
+            snapshots are kept
+        :type content: str
+        :rtype: str
+        """
+        snapshot = OrderedDict((name, metric.snapshot())
+                               for name, metric in self.metrics.items())
+        if command:
+            try:
+                data = json.loads(content or '{}',
+                                  object_pairs_hook=OrderedDict)
+            except ValueError:
+                data = OrderedDict()
+            if not isinstance(data, dict):
+                data = OrderedDict()
+            data[command] = snapshot
+            snapshot = data
+        return json.dumps(snapshot, indent=2)
+
+    def write(self, path, command=None):
+        """Write metrics to a file, as JSON if path ends with .json and in
+        Prometheus text format otherwise. The file is replaced atomically so
+        a collector never reads a partial file.
+
+        With a command, samples are labelled with it (nested under it in
+        JSON) and samples of other commands in the file are kept, so that
+        commands can share a metrics file.
+        :param path: path to metrics file
+        :type path: str
+        :param command: name of command, e.g. 'split'
+        :type command: str
+        :returns: None
+        """
+        content = read_file(path) if command else None
+        if path.endswith('.json'):
+            content = self.to_json(command, content)
+        else:
+            content = self.to_text(command, content)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        if os.name == 'nt' and os.path.exists(path):
+            # rename does not replace files on windows in python 2
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+registry = Registry()
+
+# option of commands writing run metrics
+metrics_option = click.option(
+    '--metrics-path', help='Write run metrics to this file, as JSON if it '
+    'ends with .json and in Prometheus text format otherwise. Default to '
+    'ATTBS_METRICS_PATH.'
+)
+
+
+def read_file(path):
+    """Read a metrics file.
+
+    :returns: content, None if file is missing
+    :rtype: str
+    """
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def parse_families(content):
+    """Split a Prometheus textfile into metric families.
+
+    :param content: textfile content
+    :type content: str
+    :returns: ordered dict of metric name to dict of help, type and sample
+        lines
+    :rtype: OrderedDict
+    """
+    families = OrderedDict()
+    family = None
+    for line in content.splitlines():
+        if line.startswith('# HELP ') or line.startswith('# TYPE '):
+            parts = line.split(' ', 3)
+            if len(parts) < 3:
+                continue
+
+            family = families.setdefault(
+                parts[2], {'help': '', 'type': 'untyped', 'samples': []}
+            )
+            family[parts[1].lower()] = parts[3] if len(parts) > 3 else ''
+        elif line.strip() and not line.startswith('#') and family:
+            family['samples'].append(line)
+    return families
+
+
+def sample_command(line):
+    """Get command label of a sample line, None if it has none."""
+    m = re.search(r'[{,]command="([^"]*)"', line)
+    return m.group(1) if m else None
+
+
+def format_value(value):
+    """Format a number as Prometheus does."""
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if value.is_integer():
+            return '{:.1f}'.format(value)
+        return repr(value)
+    return '{}'.format(value)
+
+
+def counter(name, documentation):
+    """Register a counter named attbs_<name>.
+
+    :rtype: Counter
+    """
+    return registry.register(Counter(name, documentation))
+
+
+def gauge(name, documentation):
+    """Register a gauge named attbs_<name>.
+
+    :rtype: Gauge
+    """
+    return registry.register(Gauge(name, documentation))
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    """Register a histogram named attbs_<name>.
+
+    :rtype: Histogram
+    """
+    return registry.register(Histogram(name, documentation, buckets))
+
+
+def timed(func, *args):
+    """Call a function and measure its duration. It can be submitted to a
+    process pool, whose workers do not share the registry.
+
+    :returns: tuple of result and seconds spent
+    :rtype: tuple
+    """
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+@contextmanager
+def count_statements(database, metric):
+    """Observe number of SQL statements run on the connection of the current
+    thread while in the context. Nothing is observed on python 2, whose
+    sqlite3 module cannot trace statements.
+
+    :param database: database
+    :type database: SqliteDatabase
+    :param metric: histogram of statement counts
+    :type metric: Histogram
+    """
+    conn = database.get_conn()
+    if not hasattr(conn, 'set_trace_callback'):
+        yield
+        return
+
+    statements = [0]
+
+    def trace(sql):
+        statements[0] += 1
+
+    conn.set_trace_callback(trace)
+    try:
+        yield
+    finally:
+        conn.set_trace_callback(None)
+        metric.observe(statements[0])
+
+
+def read_value(path, name, command):
+    """Read value of a metric of a command from a file written by
+    `Registry.write`.
+
+    :param path: path to metrics file
+    :type path: str
+    :param name: name of metric, e.g. 'attbs_last_success_timestamp_seconds'
+    :type name: str
+    :param command: name of command, e.g. 'split'
+    :type command: str
+    :returns: value, None if file or metric is missing
+    :rtype: float
+    """
+    content = read_file(path)
+    if content is None:
+        return None
+
+    if path.endswith('.json'):
+        try:
+            value = json.loads(content).get(command, {}).get(name)
+        except (ValueError, AttributeError):
+            return None
+        return value if isinstance(value, (int, float)) else None
+
+    sample = '{}{{command="{}"}}'.format(name, command)
+    for line in content.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == sample:
+            try:
+                return float(parts[1])
+            except ValueError:
+                return None
+    return None
+
+
+@contextmanager
+def run_metrics(command, path=None, metrics=None):
+    """Record duration and outcome of a command run, then write all metrics
+    to path if given. Samples are labelled with the command and samples of
+    other commands in the file are kept. The time of the last success
+    written by an earlier run is kept when the command fails.
+
+    :param command: name of command, e.g. 'split'
+    :type command: str
+    :param path: path to metrics file, .json for a JSON snapshot
+    :type path: str
+    :param metrics: registry to write. Default to registry of process
+    :type metrics: Registry
+    """
+    metrics = metrics or registry
+    duration = metrics.register(
+        Gauge('run_duration_seconds', 'Duration of the last run.')
+    )
+    last_success = metrics.register(
+        Gauge('last_success_timestamp_seconds',
+              'Unix time of the last successful run.')
+    )
+    if path:
+        last_success.set(read_value(path, last_success.name, command) or 0)
+    start = time.time()
+    try:
+        yield
+        last_success.set(time.time())
+    finally:
+        duration.set(time.time() - start)
+        if path:
+            metrics.write(path, command)
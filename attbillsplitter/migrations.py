@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+"""Versioned schema migrations for the bill database.
+
+Schema version is stored in `PRAGMA user_version`. Each migration is applied
+once, in order, in its own transaction. New migrations are added to the end
+of MIGRATIONS and must never be reordered or removed.
+"""
+
+from __future__ import print_function, unicode_literals
+from playhouse.migrate import SqliteMigrator, migrate
+from attbillsplitter.models import (
+    BackfillCycle, BillingCycle, ChargeSummary, Notification, OutboxMessage,
+    db
+)
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """Register a migration. Its version is its position in MIGRATIONS."""
+    MIGRATIONS.append(func)
+    return func
+
+
+def add_column_if_missing(migrator, model, name):
+    """Add a model field to its table unless the column exists already,
+    which is the case when the table was created by a newer version.
+    """
+    table = model._meta.db_table
+    field = model._meta.fields[name]
+    columns = [c.name for c in migrator.database.get_columns(table)]
+    if field.db_column not in columns:
+        migrate(migrator.add_column(table, field.db_column, field))
+
+
+@migration
+def add_report_indexes(migrator):
+    """Add covering indexes for the report queries, which filter by billing
+    cycle first. They replace the single column billing cycle indexes.
+    """
+    database = migrator.database
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "charge_billing_cycle_id_user_id_'
+        'charge_type_id_amount" ON "charge" ("billing_cycle_id", "user_id", '
+        '"charge_type_id", "amount")'
+    )
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "monthlybill_billing_cycle_id_user_id_'
+        'total" ON "monthlybill" ("billing_cycle_id", "user_id", "total")'
+    )
+    database.execute_sql('DROP INDEX IF EXISTS "charge_billing_cycle_id"')
+    database.execute_sql(
+        'DROP INDEX IF EXISTS "monthlybill_billing_cycle_id"'
+    )
+
+
+@migration
+def add_archive_tables(migrator):
+    """Add summary table and archive flag used by history archival."""
+    ChargeSummary.create_table(fail_silently=True)
+    add_column_if_missing(migrator, BillingCycle, 'archived_at')
+
+
+@migration
+def add_notification_table(migrator):
+    """Add table recording text messages sent."""
+    Notification.create_table(fail_silently=True)
+
+
+@migration
+def add_backfill_table(migrator):
+    """Add table recording progress of splitting bill history."""
+    BackfillCycle.create_table(fail_silently=True)
+
+
+@migration
+def add_billing_cycle_updated_at(migrator):
+    """Add time of last change of billing cycles, used by HTTP caching."""
+    add_column_if_missing(migrator, BillingCycle, 'updated_at')
+
+
+@migration
+def add_outbox_table(migrator):
+    """Add table of text messages waiting to be sent."""
+    OutboxMessage.create_table(fail_silently=True)
+
+
+@migration
+def add_outbox_digest_column(migrator):
+    """Add billing cycles covered by digest messages to outbox."""
+    add_column_if_missing(migrator, OutboxMessage, 'digest_cycles')
+
+
+def get_schema_version(database=db):
+    """Get schema version of database.
+
+    :param database: database
+    :type database: SqliteDatabase
+    :returns: version of the last migration applied
+    :rtype: int
+    """
+    return database.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def migrate_database(database=db):
+    """Apply migrations newer than schema version of database.
+
+    :param database: database
+    :type database: SqliteDatabase
+    :returns: list of versions applied
+    :rtype: list
+    """
+    migrator = SqliteMigrator(database)
+    applied = []
+    version = get_schema_version(database)
+    for new_version, func in enumerate(MIGRATIONS[version:], version + 1):
+        with database.atomic():
+            func(migrator)
+            database.execute_sql(
+                'PRAGMA user_version = {:d}'.format(new_version)
+            )
+        applied.append(new_version)
+    return applied
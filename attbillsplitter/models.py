@@ -46,6 +46,10 @@ class BillingCycle(BaseModel):
     start_date = DateField(unique=True)
     end_date = DateField(unique=True)
     created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+    # set when charges are moved to archive database
+    archived_at = DateTimeField(null=True)
+    # UTC like created_at, set whenever charges change
+    updated_at = DateTimeField(null=True)
 
 
 class Charge(BaseModel):
@@ -68,3 +72,75 @@ class MonthlyBill(BaseModel):
                                     related_name='mb_billing_cycle')
     total = FloatField()
     created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+
+
+class ChargeSummary(BaseModel):
+    """Per charge type sums of an archived billing cycle."""
+    billing_cycle = ForeignKeyField(BillingCycle,
+                                    related_name='cs_billing_cycle')
+    charge_type = ForeignKeyField(ChargeType, related_name='cs_charge_type')
+    total = FloatField()
+    line_count = IntegerField()
+    created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+
+    class Meta:
+        indexes = (
+            (('billing_cycle', 'charge_type'), True),
+        )
+
+
+class Notification(BaseModel):
+    """Charge details sent to a line for a billing cycle."""
+    billing_cycle = ForeignKeyField(BillingCycle,
+                                    related_name='n_billing_cycle')
+    user = ForeignKeyField(User, related_name='n_user')
+    message_sid = CharField(null=True)
+    sent_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+
+    class Meta:
+        indexes = (
+            (('billing_cycle', 'user'), False),
+        )
+
+
+class BackfillCycle(BaseModel):
+    """Progress of splitting a billing cycle of an account, so that an
+    interrupted run can be resumed without crawling bill history again.
+    """
+    account = CharField()
+    billing_cycle_name = CharField()
+    bill_link = CharField()
+    # pending, done or failed
+    status = CharField(default='pending')
+    attempts = IntegerField(default=0)
+    error = TextField(null=True)
+    updated_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+
+    class Meta:
+        indexes = (
+            (('account', 'billing_cycle_name'), True),
+        )
+
+
+class OutboxMessage(BaseModel):
+    """Text message of charge details waiting to be sent to a line."""
+    billing_cycle = ForeignKeyField(BillingCycle,
+                                    related_name='om_billing_cycle')
+    user = ForeignKeyField(User, related_name='om_user')
+    number = CharField()
+    body = TextField()
+    # pending, sending, delivered or failed
+    status = CharField(default='pending')
+    attempts = IntegerField(default=0)
+    message_sid = CharField(null=True)
+    error = TextField(null=True)
+    # comma separated ids of earlier billing cycles covered by a digest
+    digest_cycles = TextField(null=True)
+    claimed_at = DateTimeField(null=True)
+    delivered_at = DateTimeField(null=True)
+    created_at = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+
+    class Meta:
+        indexes = (
+            (('billing_cycle', 'user'), True),
+        )
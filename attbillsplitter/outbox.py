@@ -0,0 +1,311 @@
+# -*- coding:utf-8 -*-
+"""Durable outbox of text messages.
+
+Messages are written to the outbox, one per billing cycle and line, before
+anything is sent. Dispatcher workers claim messages one at a time, send them
+and mark them delivered together with a Notification record, so a run that
+dies halfway is resumed by running it again: lines already notified are
+never sent again. A message left sending by a run that died may or may not
+have reached Twilio, so it is not sent again unless the user confirms it.
+"""
+
+from __future__ import print_function, unicode_literals
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import logging
+import attbillsplitter.metrics as metrics
+from attbillsplitter.models import Notification, OutboxMessage, db
+
+PENDING = 'pending'
+SENDING = 'sending'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SMS_SENT = metrics.counter('sms_sent_total', 'Text messages sent.')
+SMS_FAILED = metrics.counter('sms_failed_total',
+                             'Text messages failed to send.')
+SMS_SEND_SECONDS = metrics.histogram('sms_send_duration_seconds',
+                                     'Latency of sending a text message.')
+
+
+def get_message(billing_cycle, user_id):
+    """Get message of a line for a billing cycle.
+
+    :param billing_cycle: billing cycle
+    :type billing_cycle: BillingCycle
+    :param user_id: id of user
+    :type user_id: int
+    :returns: message, None if not in outbox
+    :rtype: OutboxMessage
+    """
+    return OutboxMessage.select().where(
+        OutboxMessage.billing_cycle == billing_cycle.id,
+        OutboxMessage.user == user_id
+    ).first()
+
+
+def is_notified(billing_cycle, user_id):
+    """Check whether a line was notified of a billing cycle, through the
+    outbox or before it existed.
+
+    :param billing_cycle: billing cycle
+    :type billing_cycle: BillingCycle
+    :param user_id: id of user
+    :type user_id: int
+    :rtype: bool
+    """
+    return Notification.select().where(
+        Notification.billing_cycle == billing_cycle.id,
+        Notification.user == user_id
+    ).exists()
+
+
+def enqueue(billing_cycle, user_id, number, body, digest_cycles=(),
+            resend=False):
+    """Put a message in the outbox. A message not sent yet is replaced,
+    nothing is queued for a line already notified of the billing cycle.
+
+    :param billing_cycle: billing cycle
+    :type billing_cycle: BillingCycle
+    :param user_id: id of user
+    :type user_id: int
+    :param number: number to send message to
+    :type number: str
+    :param body: message body
+    :type body: str
+    :param digest_cycles: ids of earlier billing cycles also covered by the
+        message, which are marked notified when it is delivered
+    :type digest_cycles: list
+    :param resend: also replace a message left sending by a run that did not
+        finish, which may have been delivered
+    :type resend: bool
+    :returns: True if message will be sent
+    :rtype: bool
+    """
+    digest_cycles = ','.join(str(bc_id) for bc_id in digest_cycles) or None
+    statuses = [PENDING, FAILED] + ([SENDING] if resend else [])
+    with db.atomic():
+        if is_notified(billing_cycle, user_id):
+            return False
+
+        message = get_message(billing_cycle, user_id)
+        if message is None:
+            OutboxMessage.create(billing_cycle=billing_cycle.id,
+                                 user=user_id, number=number, body=body,
+                                 digest_cycles=digest_cycles)
+            return True
+
+        return OutboxMessage.update(
+            number=number, body=body, digest_cycles=digest_cycles,
+            status=PENDING, error=None
+        ).where(OutboxMessage.id == message.id,
+                OutboxMessage.status << statuses).execute() == 1
+
+
+def cancel(billing_cycle, user_id):
+    """Remove a message not sent yet from the outbox.
+
+    :param billing_cycle: billing cycle
+    :type billing_cycle: BillingCycle
+    :param user_id: id of user
+    :type user_id: int
+    :returns: None
+    """
+    OutboxMessage.delete().where(
+        OutboxMessage.billing_cycle == billing_cycle.id,
+        OutboxMessage.user == user_id,
+        OutboxMessage.status << [PENDING, FAILED]
+    ).execute()
+
+
+def claim(billing_cycle_ids, started_at, max_attempts=3):
+    """Claim the next message to send.
+
+    A message is claimed with a conditional update, so two workers never
+    claim the same message. Failed messages are claimed once per dispatch,
+    messages left sending by a run that did not finish are never claimed.
+    :param billing_cycle_ids: ids of billing cycles whose messages to send
+    :type billing_cycle_ids: list
+    :param started_at: start time of dispatch
+    :type started_at: datetime.datetime
+    :param max_attempts: number of attempts after which a failed message is
+        no longer sent
+    :type max_attempts: int
+    :returns: message claimed, None if nothing is left
+    :rtype: OutboxMessage
+    """
+    while True:
+        message = OutboxMessage.select().where(
+            OutboxMessage.billing_cycle << billing_cycle_ids,
+            (OutboxMessage.status == PENDING) |
+            ((OutboxMessage.status == FAILED) &
+             (OutboxMessage.attempts < max_attempts) &
+             (OutboxMessage.claimed_at < started_at))
+        ).order_by(OutboxMessage.id).first()
+        if message is None:
+            return None
+
+        claimed = OutboxMessage.update(
+            status=SENDING, claimed_at=dt.datetime.utcnow(),
+            attempts=OutboxMessage.attempts + 1
+        ).where(OutboxMessage.id == message.id,
+                OutboxMessage.status == message.status,
+                OutboxMessage.attempts == message.attempts).execute()
+        if claimed:
+            return message
+
+
+def mark_delivered(message, message_sid):
+    """Mark a message delivered and record the notification of each billing
+    cycle it covers, unless the line was notified of it meanwhile.
+
+    :param message: message sent
+    :type message: OutboxMessage
+    :param message_sid: sid of the text message
+    :type message_sid: str
+    :returns: None
+    """
+    with db.atomic():
+        OutboxMessage.update(
+            status=DELIVERED, message_sid=message_sid, error=None,
+            delivered_at=dt.datetime.utcnow()
+        ).where(OutboxMessage.id == message.id).execute()
+        bc_ids = [message.billing_cycle_id]
+        if message.digest_cycles:
+            bc_ids.extend(int(bc_id)
+                          for bc_id in message.digest_cycles.split(','))
+        notified = set(
+            bc_id for (bc_id,) in Notification
+            .select(Notification.billing_cycle)
+            .where(Notification.billing_cycle << bc_ids,
+                   Notification.user == message.user_id)
+            .tuples()
+        )
+        rows = [{'billing_cycle': bc_id, 'user': message.user_id,
+                 'message_sid': message_sid}
+                for bc_id in bc_ids if bc_id not in notified]
+        if rows:
+            Notification.insert_many(rows).execute()
+
+
+def mark_failed(message, error):
+    """Mark a message failed so that it is sent again on next dispatch.
+
+    :param message: message failed to send
+    :type message: OutboxMessage
+    :param error: error raised when sending
+    :type error: Exception
+    :returns: None
+    """
+    OutboxMessage.update(
+        status=FAILED, error='{}: {}'.format(type(error).__name__, error)
+    ).where(OutboxMessage.id == message.id).execute()
+
+
+def get_sending(billing_cycles):
+    """Get messages left sending by a run that did not finish. Call it when
+    no dispatch is running.
+
+    :param billing_cycles: billing cycles
+    :type billing_cycles: list
+    :returns: messages which may or may not have been delivered
+    :rtype: list
+    """
+    return list(OutboxMessage.select().where(
+        OutboxMessage.billing_cycle << [bc.id for bc in billing_cycles],
+        OutboxMessage.status == SENDING
+    ).order_by(OutboxMessage.id))
+
+
+def send(message_client, message):
+    """Send a claimed message and record the outcome. A message sent but not
+    recorded is left sending, so that it is not sent again.
+
+    :param message_client: a message client to send text message
+    :type message_client: MessageClient
+    :param message: message claimed
+    :type message: OutboxMessage
+    :returns: True if message was delivered
+    :rtype: bool
+    """
+    try:
+        with SMS_SEND_SECONDS.time():
+            message_sid = message_client.send_message(body=message.body,
+                                                      to=message.number)
+    except Exception as e:
+        SMS_FAILED.inc()
+        try:
+            mark_failed(message, e)
+        except Exception:
+            logger.exception('failure of message %s not recorded',
+                             message.id)
+        print('\U0001F6AB  Failed sending message to {}: {}'.format(
+            message.number, e))
+        return False
+
+    SMS_SENT.inc()
+    try:
+        mark_delivered(message, message_sid)
+    except Exception as e:
+        logger.exception('delivery of message %s not recorded', message.id)
+        print('\U000026A0  Message sent to {} but not recorded: {}'.format(
+            message.number, e))
+        return True
+
+    logger.info('charge details sent', extra={
+        'billing_cycle': message.billing_cycle.name,
+        'number': message.number,
+        'message_sid': message_sid,
+    })
+    print('\U00002705  Message sent to {}'.format(message.number))
+    return True
+
+
+def dispatch(message_client, billing_cycles, workers=1, max_attempts=3):
+    """Send messages in outbox for billing cycles.
+
+    :param message_client: a message client to send text message, shared by
+        workers
+    :type message_client: MessageClient
+    :param billing_cycles: billing cycles whose messages to send
+    :type billing_cycles: list
+    :param workers: number of messages sent at a time
+    :type workers: int
+    :param max_attempts: number of attempts after which a failed message is
+        no longer sent
+    :type max_attempts: int
+    :returns: tuple of number of messages delivered and failed
+    :rtype: tuple
+    """
+    bc_ids = [bc.id for bc in billing_cycles]
+    started_at = dt.datetime.utcnow()
+
+    def work():
+        results = []
+        while True:
+            message = claim(bc_ids, started_at, max_attempts)
+            if message is None:
+                return results
+
+            results.append(send(message_client, message))
+
+    if workers <= 1:
+        results = work()
+    else:
+        def work_in_thread():
+            try:
+                return work()
+            finally:
+                # each thread has its own database connection
+                if not db.is_closed():
+                    db.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(work_in_thread)
+                       for _ in range(workers)]
+            results = [r for future in futures for r in future.result()]
+    delivered = sum(results)
+    return delivered, len(results) - delivered
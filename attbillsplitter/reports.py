@@ -0,0 +1,253 @@
+# -*- coding:utf-8 -*-
+"""Report engine that groups wireless charges by billing cycle and line.
+
+Console printing and text messages in services module are built on top of
+the records yielded here.
+"""
+
+from __future__ import unicode_literals
+from collections import namedtuple
+import datetime as dt
+import heapq
+from itertools import groupby
+import peewee as pw
+from attbillsplitter.models import (
+    User, ChargeCategory, ChargeType, BillingCycle, Charge, MonthlyBill,
+    Notification
+)
+
+# charges is a list of tuples of charge type text and amount
+LineReport = namedtuple(
+    'LineReport',
+    ['billing_cycle', 'user_id', 'name', 'number', 'charges', 'total']
+)
+
+
+def billing_cycle_query(month, year=None):
+    """Query billing cycle by the month of its end date.
+
+    :param month: month (1 - 12) of the end date of billing cycle
+    :type month: int
+    :param year: year of the end of of billing cycle. Default to current year
+    :type year: int
+    :returns: query
+    :rtype: SelectQuery
+    """
+    # year value default to current year
+    year = year or dt.date.today().year
+    # compare with a date range so that the index on end_date can be used
+    try:
+        first_day = dt.date(year, month, 1)
+        next_first_day = dt.date(year + month // 12, month % 12 + 1, 1)
+    except ValueError:
+        # no billing cycle ends in a month out of range
+        return BillingCycle.select().where(pw.SQL('0'))
+
+    return BillingCycle.select().where(
+        BillingCycle.end_date >= first_day,
+        BillingCycle.end_date < next_first_day
+    )
+
+
+def get_billing_cycle(month, year=None):
+    """Get billing cycle by the month of its end date.
+
+    :param month: month (1 - 12) of the end date of billing cycle
+    :type month: int
+    :param year: year of the end of of billing cycle. Default to current year
+    :type year: int
+    :returns: billing cycle, None if not found
+    :rtype: BillingCycle
+    """
+    return billing_cycle_query(month, year).first()
+
+
+def wireless_charges_query(billing_cycle_ids):
+    """Query wireless charges of billing cycles grouped by line and charge
+    type.
+
+    Rows are tuples of billing cycle id, user id, name, number, charge type
+    text and total, ordered by billing cycle and line.
+    :param billing_cycle_ids: ids of billing cycles
+    :type billing_cycle_ids: list
+    :returns: query
+    :rtype: SelectQuery
+    """
+    return (
+        Charge
+        .select(Charge.billing_cycle,
+                User.id,
+                User.name,
+                User.number,
+                ChargeType.text,
+                pw.fn.SUM(Charge.amount).alias('total'))
+        .join(User)
+        .switch(Charge)
+        .join(ChargeType)
+        .join(ChargeCategory)
+        .where(Charge.billing_cycle << billing_cycle_ids,
+               ChargeCategory.category == 'wireless')
+        .group_by(Charge.billing_cycle, Charge.user, Charge.charge_type)
+        .order_by(Charge.billing_cycle, Charge.user, Charge.charge_type)
+        .tuples()
+    )
+
+
+def wireless_totals_query(billing_cycle_id):
+    """Query total wireless charges of each line in a billing cycle.
+
+    Rows are tuples of user id and total.
+    :param billing_cycle_id: id of billing cycle
+    :type billing_cycle_id: int
+    :returns: query
+    :rtype: SelectQuery
+    """
+    return (
+        Charge
+        .select(Charge.user,
+                pw.fn.SUM(Charge.amount).alias('total'))
+        .join(ChargeType)
+        .join(ChargeCategory)
+        .where(Charge.billing_cycle == billing_cycle_id,
+               ChargeCategory.category == 'wireless')
+        .group_by(Charge.user)
+        .tuples()
+    )
+
+
+def monthly_bill_query(billing_cycle_id):
+    """Query monthly bills of a billing cycle.
+
+    :param billing_cycle_id: id of billing cycle
+    :type billing_cycle_id: int
+    :returns: query
+    :rtype: SelectQuery
+    """
+    return MonthlyBill.select().where(
+        MonthlyBill.billing_cycle == billing_cycle_id
+    )
+
+
+def archived_totals_query(billing_cycle_ids):
+    """Query monthly totals of archived billing cycles, whose charges are no
+    longer in database.
+
+    Rows have the same shape as rows of `wireless_charges_query`, with None
+    as charge type text.
+    :param billing_cycle_ids: ids of billing cycles
+    :type billing_cycle_ids: list
+    :returns: query
+    :rtype: SelectQuery
+    """
+    return (
+        MonthlyBill
+        .select(MonthlyBill.billing_cycle,
+                User.id,
+                User.name,
+                User.number,
+                pw.SQL('NULL'),
+                MonthlyBill.total)
+        .join(User)
+        .where(MonthlyBill.billing_cycle << billing_cycle_ids)
+        .order_by(MonthlyBill.billing_cycle, MonthlyBill.user)
+        .tuples()
+    )
+
+
+def unnotified_totals_query(start_date=None, end_date=None):
+    """Query monthly totals of lines for billing cycles they were not
+    notified of.
+
+    Rows are tuples of user id, name, number, billing cycle id and total,
+    ordered by line and billing cycle end date.
+    :param start_date: earliest end date of billing cycles
+    :type start_date: datetime.date
+    :param end_date: latest end date of billing cycles
+    :type end_date: datetime.date
+    :returns: query
+    :rtype: SelectQuery
+    """
+    query = (
+        MonthlyBill
+        .select(User.id,
+                User.name,
+                User.number,
+                MonthlyBill.billing_cycle,
+                pw.fn.SUM(MonthlyBill.total).alias('total'))
+        .join(User)
+        .switch(MonthlyBill)
+        .join(BillingCycle)
+        .join(Notification, pw.JOIN.LEFT_OUTER, on=(
+            (Notification.billing_cycle == MonthlyBill.billing_cycle) &
+            (Notification.user == MonthlyBill.user)
+        ))
+        .where(Notification.id >> None)
+        .group_by(MonthlyBill.user, MonthlyBill.billing_cycle)
+        .order_by(MonthlyBill.user, BillingCycle.end_date)
+        .tuples()
+    )
+    if start_date:
+        query = query.where(BillingCycle.end_date >= start_date)
+    if end_date:
+        query = query.where(BillingCycle.end_date <= end_date)
+    return query
+
+
+def notification_query(billing_cycle_id, user_id):
+    """Query notifications sent to a line for a billing cycle, latest first.
+
+    :param billing_cycle_id: id of billing cycle
+    :type billing_cycle_id: int
+    :param user_id: id of user
+    :type user_id: int
+    :returns: query
+    :rtype: SelectQuery
+    """
+    return Notification.select().where(
+        Notification.billing_cycle == billing_cycle_id,
+        Notification.user == user_id
+    ).order_by(Notification.id.desc())
+
+
+def execute_query(query):
+    """Run a query on the database of its model.
+
+    :param query: query
+    :type query: SelectQuery
+    :returns: rows
+    :rtype: iterable
+    """
+    return query.execute()
+
+
+def iter_line_reports(billing_cycles, execute=execute_query):
+    """Run a single query for billing cycles and yield wireless charges of
+    each line in each billing cycle.
+
+    Archived billing cycles only have totals, their charges are empty.
+    :param billing_cycles: billing cycles to report, any objects with `id`
+        and `archived_at` attributes
+    :type billing_cycles: list
+    :param execute: function running a query and returning its rows as
+        tuples. Default to `execute_query`
+    :type execute: function
+    :yields: LineReport
+    """
+    bcs = {bc.id: bc for bc in billing_cycles}
+    live_ids = [bc_id for bc_id, bc in bcs.items() if not bc.archived_at]
+    archived_ids = [bc_id for bc_id, bc in bcs.items() if bc.archived_at]
+    queries = []
+    if live_ids:
+        queries.append(wireless_charges_query(live_ids))
+    if archived_ids:
+        queries.append(archived_totals_query(archived_ids))
+
+    # both queries are ordered by billing cycle and line
+    rows = heapq.merge(*[(tuple(row) for row in execute(q))
+                         for q in queries])
+    for (bc_id, user_id, name, number), charges in groupby(
+            rows, key=lambda row: row[:4]):
+        charges = [(text, total) for (_, _, _, _, text, total) in charges]
+        yield LineReport(bcs[bc_id], user_id, name, number,
+                         [c for c in charges if c[0] is not None],
+                         sum(total for (_, total) in charges))
@@ -5,25 +5,40 @@
 from __future__ import print_function, unicode_literals
 from builtins import input
 import datetime as dt
+from itertools import groupby
 import logging
 import click
-import peewee as pw
 import warnings
+import attbillsplitter.analytics as analytics
+import attbillsplitter.metrics as metrics
+import attbillsplitter.outbox as outbox
 import attbillsplitter.utils as utils
 from twilio.rest import TwilioRestClient
 from twilio.exceptions import TwilioException
-from attbillsplitter.models import (
-    User, ChargeCategory, ChargeType, BillingCycle, Charge, MonthlyBill, db
+from attbillsplitter.errors import ConfigError
+from attbillsplitter.logs import notification_log
+from attbillsplitter.main import create_tables_if_not_exist
+from attbillsplitter.models import BillingCycle
+from attbillsplitter.reports import (
+    get_billing_cycle, iter_line_reports, notification_query,
+    unnotified_totals_query
 )
 
 warnings.simplefilter('ignore')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-ch = logging.FileHandler(utils.LOG_PATH)
-ch.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+
+# characters of the GSM 03.38 alphabet; the extension ones take two
+GSM7_BASIC = (
+    '@\u00a3$\u00a5\u00e8\u00e9\u00f9\u00ec\u00f2\u00c7\n\u00d8\u00f8\r'
+    '\u00c5\u00e5\u0394_\u03a6\u0393\u039b\u03a9\u03a0\u03a8\u03a3\u0398'
+    '\u039e\u00c6\u00e6\u00df\u00c9 !"#\u00a4%&\'()*+,-./0123456789:;<=>?'
+    '\u00a1ABCDEFGHIJKLMNOPQRSTUVWXYZ\u00c4\u00d6\u00d1\u00dc\u00a7\u00bf'
+    'abcdefghijklmnopqrstuvwxyz\u00e4\u00f6\u00f1\u00fc\u00e0'
+)
+GSM7_EXTENDED = '^{}\\[~]|\u20ac\f'
+# Twilio recommends keeping a message within 10 segments
+MAX_SEGMENTS = 10
 
 
 def print_wireless_monthly_summary(month, year=None):
@@ -36,38 +51,20 @@ def print_wireless_monthly_summary(month, year=None):
     :type year: int
     :returns: None
     """
-    # year value default to current year
-    year = year or dt.date.today().year
-    if not BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).exists():
-        print('No charge summary found for {}/{}. Please split the '
-              'bill first'.format(year, month))
+    bc = get_billing_cycle(month, year)
+    if not bc:
+        print_not_found(month, year)
         return
 
-    bc = BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).get()
     print('\n--------------------------------------------------------------')
     print('    Charge Summary for Billing Cycle {}'.format(bc.name))
     print('--------------------------------------------------------------')
-    query = (
-        User
-        .select(User.name,
-                User.number,
-                MonthlyBill.total)
-        .join(MonthlyBill)
-        .where(MonthlyBill.billing_cycle_id == bc.id)
-        .naive()
-    )
     wireless_total = 0
-    for user in query.execute():
+    for report in iter_line_reports([bc]):
         print('    {:^18s} ({})      Total: {:.2f}'.format(
-            user.name, user.number, user.total
+            report.name, report.number, report.total
         ))
-        wireless_total += user.total
+        wireless_total += report.total
     print('--------------------------------------------------------------')
     print('{:>47}: {:.2f}\n'.format('Wireless Total', wireless_total))
 
@@ -82,63 +79,255 @@ def print_wireless_monthly_details(month, year=None):
     :type year: int
     :returns: None
     """
-    # year value default to current year
-    year = year or dt.date.today().year
-    if not BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).exists():
-        print('No charge summary found for {}/{}. Please split the '
-              'bill first'.format(year, month))
+    bc = get_billing_cycle(month, year)
+    if not bc:
+        print_not_found(month, year)
         return
 
-    bc = BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).get()
-    query = (
-        User
-        .select(User.id,
-                User.name,
-                User.number,
-                ChargeType.text.alias('charge_type'),
-                pw.fn.SUM(Charge.amount).alias('total'))
-        .join(Charge)
-        .join(BillingCycle)
-        .switch(Charge)
-        .join(ChargeType)
-        .join(ChargeCategory)
-        .where(BillingCycle.id == bc.id,
-               ChargeCategory.category == 'wireless')
-        .group_by(User, BillingCycle, ChargeType)
-        .order_by(User.id)
-        .naive()
-    )
-    current_user_num = ''
-    current_user_total = 0
     wireless_total = 0
     print('')
-    for user in query.execute():
-        if user.number != current_user_num:
-            if current_user_total:
-                print('      - {:40}   {:.2f}\n'.format('Total',
-                                                        current_user_total))
-                wireless_total += current_user_total
-            current_user_num = user.number
-            current_user_total = 0
-            print('    {} ({})'.format(user.name, user.number))
-        print('      - {:40}   {:.2f}'.format(user.charge_type, user.total))
-        current_user_total += user.total
-    if current_user_total:
-        print('      - {:40}   {:.2f}\n'.format('Total', current_user_total))
-        wireless_total += current_user_total
+    for report in iter_line_reports([bc]):
+        print('    {} ({})'.format(report.name, report.number))
+        for charge_type, total in report.charges:
+            print('      - {:40}   {:.2f}'.format(charge_type, total))
+        print('      - {:40}   {:.2f}\n'.format('Total', report.total))
+        wireless_total += report.total
     print('{:>48}: {:.2f}\n'.format('Wireless Total', wireless_total))
 
 
+def get_unusual_charges(billing_cycle):
+    """Find unusual charges of lines in a billing cycle. Nothing is found
+    without NumPy.
+
+    :param billing_cycle: billing cycle
+    :type billing_cycle: BillingCycle
+    :returns: dict of number to list of unusual charges of the line
+    :rtype: dict
+    """
+    if analytics.np is None:
+        return {}
+
+    unusual = {}
+    store = analytics.ChargeStore.load()
+    for anomaly in analytics.find_anomalies(store, [billing_cycle.name]):
+        unusual.setdefault(anomaly.number, []).append(anomaly)
+    return unusual
+
+
+def print_anomaly(anomaly):
+    """Print an unusual charge.
+
+    :param anomaly: unusual charge
+    :type anomaly: Anomaly
+    :returns: None
+    """
+    print('\U0001F6A8  Unusual {}: {:.2f}, usually {:.2f} '
+          '(z-score {:.1f})'.format(anomaly.charge_type, anomaly.amount,
+                                    anomaly.baseline, anomaly.z_score))
+
+
+def print_unusual_charges(month=None, year=None, threshold=3.0, window=6):
+    """Print charges far from the usual amounts of their line and charge
+    type. Results will be printed to console.
+
+    :param month: month (1 - 12) of the end date of billing cycle. Default
+        to all billing cycles
+    :type month: int
+    :param year: year of the end of of billing cycle. Default to current year
+    :type year: int
+    :param threshold: absolute z-score from which a charge is unusual
+    :type threshold: float
+    :param window: number of previous billing cycles in baseline
+    :type window: int
+    :returns: None
+    """
+    bc_names = None
+    if month:
+        bc = get_billing_cycle(month, year)
+        if not bc:
+            print_not_found(month, year)
+            return
+
+        bc_names = [bc.name]
+    store = analytics.ChargeStore.load()
+    anomalies = analytics.find_anomalies(store, bc_names, threshold, window)
+    last = None
+    for anomaly in anomalies:
+        line = (anomaly.billing_cycle, anomaly.number)
+        if line != last:
+            print('\n    {} ({}) - {}'.format(anomaly.name, anomaly.number,
+                                              anomaly.billing_cycle))
+            last = line
+        print_anomaly(anomaly)
+    if not anomalies:
+        print('\U00002705  No unusual charges found.')
+
+
+def render_message(report):
+    """Render charge details of a line as a text message.
+
+    :param report: charge details of a line
+    :type report: LineReport
+    :returns: message
+    :rtype: str
+    """
+    message = ('Hi {} ({}),\nYour AT&T Wireless Charges '
+               'for {}:\n'.format(report.name, report.number,
+                                  report.billing_cycle.name))
+    for charge_type, total in report.charges:
+        message += '  - {:30} {:.2f}\n'.format(charge_type, total)
+    message += '  - {:30} {:.2f} \U0001F911\n'.format('Total', report.total)
+    return message
+
+
+def count_segments(text):
+    """Count SMS segments needed to send text. Text that fits in the GSM
+    alphabet takes 160 characters in a single segment and 153 per segment
+    otherwise, any other text takes 70 and 67 UTF-16 code units.
+
+    :param text: message body
+    :type text: str
+    :returns: number of segments
+    :rtype: int
+    """
+    if all(c in GSM7_BASIC or c in GSM7_EXTENDED for c in text):
+        length = sum(2 if c in GSM7_EXTENDED else 1 for c in text)
+        single, multi = 160, 153
+    else:
+        length = len(text.encode('utf-16-le')) // 2
+        single, multi = 70, 67
+    if length <= single:
+        return 1
+    return -(-length // multi)
+
+
+def render_digest(name, number, cycles, payment_msg,
+                  max_segments=MAX_SEGMENTS):
+    """Render totals of several billing cycles of a line as a text message.
+
+    The oldest billing cycles are folded into a single line until the
+    message fits in `max_segments` segments, all of them if need be.
+    :param name: name of line
+    :type name: str
+    :param number: number of line
+    :type number: str
+    :param cycles: list of tuples of billing cycle and total, oldest first
+    :type cycles: list
+    :param payment_msg: text appended so that users know how to pay you
+    :type payment_msg: str
+    :param max_segments: number of segments the message should fit in
+    :type max_segments: int
+    :returns: message, None if it cannot fit in `max_segments` segments
+    :rtype: str
+    """
+    grand_total = sum(total for _, total in cycles)
+    for folded in range(len(cycles) + 1):
+        lines = ['Hi {} ({}),'.format(name, number),
+                 'Your AT&T Wireless Charges:']
+        if folded:
+            lines.append('Earlier ({}): {:.2f}'.format(
+                folded, sum(total for _, total in cycles[:folded])
+            ))
+        lines.extend('{}: {:.2f}'.format(bc.end_date.strftime('%b %Y'),
+                                         total)
+                     for bc, total in cycles[folded:])
+        lines.append('Total: {:.2f}'.format(grand_total))
+        lines.append(payment_msg)
+        message = '\n'.join(lines)
+        if count_segments(message) <= max_segments:
+            return message
+    return None
+
+
+def notify_users_digest(message_client, payment_msg, start_date=None,
+                        end_date=None, confirm=True, workers=1,
+                        max_segments=MAX_SEGMENTS):
+    """Notify each user of all billing cycles not notified yet in a single
+    message.
+
+    Totals of all lines are fetched with a single query. Messages confirmed
+    are put in the outbox and sent in one batch, so a single message is sent
+    to each line whatever the number of billing cycles.
+    :param message_client: a message client to send text message
+    :type message_client: MessageClient
+    :param payment_msg: text appended to totals so that your users know how
+        to pay you.
+    :type payment_msg: str
+    :param start_date: earliest end date of billing cycles
+    :type start_date: datetime.date
+    :param end_date: latest end date of billing cycles
+    :type end_date: datetime.date
+    :param confirm: ask before sending each message
+    :type confirm: bool
+    :param workers: number of messages sent at a time
+    :type workers: int
+    :param max_segments: number of segments messages should fit in
+    :type max_segments: int
+    :returns: None
+    """
+    rows = list(unnotified_totals_query(start_date, end_date).execute())
+    bc_ids = set(bc_id for (_, _, _, bc_id, _) in rows)
+    bcs = {}
+    if bc_ids:
+        bcs = {bc.id: bc for bc in
+               BillingCycle.select().where(BillingCycle.id << list(bc_ids))}
+    latest_bcs = {}
+    print('')
+    for (user_id, name, number), line_rows in groupby(
+            rows, key=lambda row: row[:3]):
+        cycles = [(bcs[bc_id], total) for (_, _, _, bc_id, total) in line_rows
+                  if total]
+        if not cycles:
+            continue
+
+        # keyed by latest billing cycle, others are marked on delivery
+        latest_bc = cycles[-1][0]
+        latest_bcs[latest_bc.id] = latest_bc
+        body = render_digest(name, number, cycles, payment_msg, max_segments)
+        print(number)
+        if body is None:
+            print('\U0001F6AB  Message does not fit in {} segments, not '
+                  'sent. Shorten the payment message or raise '
+                  '--max-segments.\n'.format(max_segments))
+            continue
+
+        print(body)
+        if not confirm_resend(outbox.get_message(latest_bc, user_id),
+                              confirm):
+            continue
+
+        notify = input('Notify (y/n)? ') if confirm else 'y'
+        if notify not in ('y', 'Y', 'yes', 'Yes', 'YES'):
+            print('')
+            continue
+
+        if outbox.enqueue(latest_bc, user_id, number, body,
+                          [bc.id for bc, _ in cycles[:-1]], resend=confirm):
+            logger.info('charge digest queued', extra={
+                'billing_cycles': [bc.name for bc, _ in cycles],
+                'number': number,
+                'total': round(sum(total for _, total in cycles), 2),
+                'segments': count_segments(body),
+            })
+        print('')
+
+    if not latest_bcs:
+        print('\U00002705  No billing cycle left to notify.')
+        return
+
+    latest_bcs = list(latest_bcs.values())
+    delivered, failed = outbox.dispatch(message_client, latest_bcs, workers)
+    print_dispatch_summary(delivered, failed, latest_bcs)
+
+
 def notify_users_monthly_details(message_client, payment_msg, month,
-                                 year=None):
+                                 year=None, confirm=True,
+                                 hold_unusual=False, workers=1):
     """Calculate monthly charge details for users and notify them.
 
+    Messages confirmed are put in the outbox first, then sent by dispatcher
+    workers. Lines already notified of the billing cycle are skipped, so
+    running it again after an interruption only sends what is left.
     :param message_client: a message client to send text message
     :type message_client: MessageClient
     :param payment_message: text appended to charge details so that your
@@ -148,73 +337,137 @@ def notify_users_monthly_details(message_client, payment_msg, month,
     :type month: int
     :param year: year of the end of of billing cycle. Default to current year
     :type year: int
+    :param confirm: ask before sending each message
+    :type confirm: bool
+    :param hold_unusual: do not notify lines with unusual charges
+    :type hold_unusual: bool
+    :param workers: number of messages sent at a time
+    :type workers: int
     :returns: None
     """
-    # year value default to current year
-    year = year or dt.date.today().year
-    if not BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).exists():
-        print('No charge summary found for {}/{}. Please split the '
-              'bill first'.format(year, month))
+    bc = get_billing_cycle(month, year)
+    if not bc:
+        print_not_found(month, year)
         return
 
-    bc = BillingCycle.select().where(
-        db.extract_date('month', BillingCycle.end_date) == month,
-        db.extract_date('year', BillingCycle.end_date) == year
-    ).get()
-    query = (
-        User
-        .select(User.id,
-                User.name,
-                User.number,
-                ChargeType.text.alias('charge_type'),
-                pw.fn.SUM(Charge.amount).alias('total'))
-        .join(Charge)
-        .join(BillingCycle)
-        .switch(Charge)
-        .join(ChargeType)
-        .join(ChargeCategory)
-        .where(BillingCycle.id == bc.id,
-               ChargeCategory.category == 'wireless')
-        .group_by(User, BillingCycle, ChargeType)
-        .order_by(User.id)
-        .naive()
-    )
-    current_user_num = -1
-    current_user_total = 0
-    messages = {}
-    message = ''
+    unusual = get_unusual_charges(bc)
     print('')
-    for user in query.execute():
-        if user.number != current_user_num:
-            if current_user_total:
-                message += '  - {:30} {:.2f} \U0001F911\n'.format(
-                    'Total', current_user_total
-                )
-                messages[current_user_num] = message
-            current_user_num = user.number
-            current_user_total = 0
-            message = ('Hi {} ({}),\nYour AT&T Wireless Charges '
-                       'for {}:\n'.format(user.name, user.number, bc.name))
-        message += '  - {:30} {:.2f}\n'.format(user.charge_type, user.total)
-        current_user_total += user.total
-    if current_user_total:
-        message += '  - {:30} {:.2f} \U0001F911\n'.format('Total',
-                                                          current_user_total)
-        messages[current_user_num] = message
-    # print message for user to confirm
-    for num, msg in messages.items():
-        print(num)
+    for report in iter_line_reports([bc]):
+        if not report.total:
+            continue
+
+        # including notifications sent before the outbox existed
+        notification = get_last_notification(bc.id, report.user_id)
+        if notification:
+            print('\U00002705  Already sent to {} at {}\n'.format(
+                report.number, notification.sent_at
+            ))
+            continue
+
+        msg = render_message(report)
+        # print message for user to confirm
+        print(report.number)
         print(msg)
-        notify = input('Notify (y/n)? ')
+        for anomaly in unusual.get(report.number, []):
+            print_anomaly(anomaly)
+        if not confirm_resend(outbox.get_message(bc, report.user_id),
+                              confirm):
+            continue
+
+        if hold_unusual and report.number in unusual:
+            outbox.cancel(bc, report.user_id)
+            print('\U000023F8  Held for review.\n')
+            continue
+
+        notify = input('Notify (y/n)? ') if confirm else 'y'
         if notify in ('y', 'Y', 'yes', 'Yes', 'YES'):
             body = '{}\n{}'.format(msg, payment_msg)
-            message_client.send_message(body=body, to=num)
-            logger.info('%s charge details sent to %s, body:\n%s',
-                        bc.name, num, msg)
-            print('\U00002705  Message sent to {}\n'.format(num))
+            if outbox.enqueue(bc, report.user_id, report.number, body,
+                              resend=confirm):
+                logger.info('charge details queued', extra={
+                    'billing_cycle': bc.name,
+                    'number': report.number,
+                    'total': round(report.total, 2),
+                    'unusual_charges': [a.charge_type for a in
+                                        unusual.get(report.number, [])],
+                })
+        else:
+            outbox.cancel(bc, report.user_id)
+        print('')
+
+    delivered, failed = outbox.dispatch(message_client, [bc], workers)
+    print_dispatch_summary(delivered, failed, [bc])
+
+
+def confirm_resend(message, confirm):
+    """Warn about a message left sending by a run that did not finish.
+
+    :param message: message of line in outbox, None if there is none
+    :type message: OutboxMessage
+    :param confirm: whether user confirms each message, otherwise the
+        message is never sent again
+    :type confirm: bool
+    :returns: True if a message may be sent to the line
+    :rtype: bool
+    """
+    if message is None or message.status != outbox.SENDING:
+        return True
+
+    print('\U000026A0  A run that did not finish was sending this message at '
+          '{} UTC. It may have been delivered, check your Twilio logs '
+          'first.'.format(message.claimed_at))
+    if not confirm:
+        print('\U000023F8  Not sent again without confirmation.\n')
+    return confirm
+
+
+def print_dispatch_summary(delivered, failed, billing_cycles):
+    """Print messages failed or left sending after a dispatch.
+
+    :param delivered: number of messages delivered
+    :type delivered: int
+    :param failed: number of messages failed
+    :type failed: int
+    :param billing_cycles: billing cycles dispatched
+    :type billing_cycles: list
+    :returns: None
+    """
+    if failed:
+        print('\U000026A0  {} messages sent, {} failed. Run again to retry '
+              'them.'.format(delivered, failed))
+    sending = outbox.get_sending(billing_cycles)
+    if sending:
+        print('\U000026A0  {} messages left sending by a run that did not '
+              'finish were not sent again: {}. Run again without '
+              '--non-interactive to confirm sending them.'.format(
+                  len(sending), ', '.join(m.number for m in sending)))
+
+
+def get_last_notification(billing_cycle_id, user_id):
+    """Get the last notification sent to a line for a billing cycle.
+
+    :param billing_cycle_id: id of billing cycle
+    :type billing_cycle_id: int
+    :param user_id: id of user
+    :type user_id: int
+    :returns: notification, None if line was not notified
+    :rtype: Notification
+    """
+    return notification_query(billing_cycle_id, user_id).first()
+
+
+def print_not_found(month, year=None):
+    """Print message for a billing cycle not split yet.
+
+    :param month: month (1 - 12) of the end date of billing cycle
+    :type month: int
+    :param year: year of the end of of billing cycle. Default to current year
+    :type year: int
+    :returns: None
+    """
+    year = year or dt.date.today().year
+    print('No charge summary found for {}/{}. Please split the '
+          'bill first'.format(year, month))
 
 
 class MessageClient(object):
@@ -225,6 +478,9 @@ class MessageClient(object):
             self.number = number
             self.twilio_client = TwilioRestClient(account_sid, auth_token)
         except TwilioException:
+            if utils.is_non_interactive():
+                raise ConfigError('Current twilio credentials invalid.')
+
             print('\U0001F6AB  Current twilio credentials invalid. '
                   'Please reset.')
             utils.initialize_twiolio()
@@ -239,9 +495,12 @@ class MessageClient(object):
         :type body: str
         :param to: number to send message to (123-456-789)
         :type to: str
-        :returns None
+        :returns: sid of the message
+        :rtype: str
         """
-        self.twilio_client.messages.create(body=body, to=to, from_=self.number)
+        message = self.twilio_client.messages.create(body=body, to=to,
+                                                     from_=self.number)
+        return message.sid
 
 
 @click.command()
@@ -253,6 +512,7 @@ def run_print_summary(month, year):
     12. You can also specify YEAR (in 4 digits). By default, YEAR is set to
     current calendar year.
     """
+    create_tables_if_not_exist()
     print_wireless_monthly_summary(month, year)
 
 
@@ -265,19 +525,119 @@ def run_print_details(month, year):
     12. You can also specify YEAR (in 4 digits). By default, YEAR is set to
     current calendar year.
     """
+    create_tables_if_not_exist()
     print_wireless_monthly_details(month, year)
 
 
+@click.command()
+@click.option('--since', type=click.DateTime(formats=['%Y-%m']),
+              help='First month (YYYY-MM) of billing cycle end dates.')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m']),
+              help='Last month (YYYY-MM) of billing cycle end dates.')
+@click.option('--payment-msg', help='Message appended to charge details. '
+              'Default to ATTBS_MESSAGE_PAYMENT or config file.')
+@click.option('--non-interactive', is_flag=True,
+              help='Never prompt, send to every user without confirmation.')
+@click.option('--workers', '-w', type=int, default=4, show_default=True,
+              help='Number of messages sent at a time.')
+@click.option('--max-segments', type=int, default=MAX_SEGMENTS,
+              show_default=True,
+              help='Fold oldest billing cycles to fit in this many SMS '
+              'segments.')
+@metrics.metrics_option
+def run_notify_digest(since, until, payment_msg, non_interactive, workers,
+                      max_segments, metrics_path):
+    """Send each user a single SMS with totals of all billing cycles they
+    were not notified of yet, and the grand total. Use --since and --until
+    to limit the billing cycles by the month of their end date.
+    """
+    if non_interactive:
+        utils.set_non_interactive()
+    utils.set_config_override('message', 'payment', payment_msg)
+    utils.set_config_override('metrics', 'path', metrics_path)
+    create_tables_if_not_exist()
+    try:
+        mc = MessageClient()
+        payment_msg = utils.load_payment_msg()
+    except ConfigError as e:
+        raise click.ClickException(str(e))
+
+    start_date = since.date() if since else None
+    end_date = None
+    if until:
+        # last day of the month
+        end_date = dt.date(until.year + until.month // 12,
+                           until.month % 12 + 1, 1) - dt.timedelta(days=1)
+    metrics_path = utils.get_config_value('metrics', 'path')
+    with notification_log(logging.getLogger('attbillsplitter')):
+        with metrics.run_metrics('digest', metrics_path):
+            notify_users_digest(
+                mc, payment_msg, start_date, end_date,
+                confirm=not utils.is_non_interactive(), workers=workers,
+                max_segments=max_segments
+            )
+
+
+@click.command()
+@click.argument('month', type=int, required=False)
+@click.option('-y', '--year', type=int)
+@click.option('--threshold', '-t', type=float, default=3.0,
+              show_default=True,
+              help='Absolute z-score from which a charge is unusual.')
+@click.option('--window', '-w', type=int, default=6, show_default=True,
+              help='Number of previous billing cycles in baseline.')
+def run_find_anomalies(month, year, threshold, window):
+    """Print charges far from the usual amounts of each user and charge type.
+    MONTH refers to the month of the end date of the billing cycle. It should
+    be an integer from 1 to 12. You can also specify YEAR (in 4 digits). By
+    default, YEAR is set to current calendar year. Without MONTH, all billing
+    cycles are checked.
+    """
+    if analytics.np is None:
+        raise click.ClickException('NumPy is required. Install '
+                                   'att-bill-splitter[analytics].')
+
+    create_tables_if_not_exist()
+    print_unusual_charges(month, year, threshold, window)
+
+
 @click.command()
 @click.argument('month', type=int)
 @click.option('-y', '--year', type=int)
-def run_notify_users(month, year):
+@click.option('--payment-msg', help='Message appended to charge details. '
+              'Default to ATTBS_MESSAGE_PAYMENT or config file.')
+@click.option('--non-interactive', is_flag=True,
+              help='Never prompt, send to every user without confirmation.')
+@click.option('--hold-unusual', is_flag=True,
+              help='Do not notify users with unusual charges.')
+@click.option('--workers', '-w', type=int, default=4, show_default=True,
+              help='Number of messages sent at a time.')
+@metrics.metrics_option
+def run_notify_users(month, year, payment_msg, non_interactive,
+                     hold_unusual, workers, metrics_path):
     """Send monthly charge details to each user via SMS. For each user, you
     will first be shown his charge details, then you can decide whether you
     want to notify him/her. MONTH refers to the month of the end date of the
     billing cycle. It should be an integer from 1 to 12. You can also specify
     YEAR (in 4 digits). By default, YEAR is set to current calendar year.
     """
-    mc = MessageClient()
-    payment_msg = utils.load_payment_msg()
-    notify_users_monthly_details(mc, payment_msg, month, year)
+    if non_interactive:
+        utils.set_non_interactive()
+    utils.set_config_override('message', 'payment', payment_msg)
+    utils.set_config_override('metrics', 'path', metrics_path)
+    create_tables_if_not_exist()
+    try:
+        mc = MessageClient()
+        payment_msg = utils.load_payment_msg()
+    except ConfigError as e:
+        raise click.ClickException(str(e))
+
+    metrics_path = utils.get_config_value('metrics', 'path')
+    # parent logger of services and outbox
+    with notification_log(logging.getLogger('attbillsplitter')):
+        with metrics.run_metrics('notify', metrics_path):
+            notify_users_monthly_details(
+                mc, payment_msg, month, year,
+                confirm=not utils.is_non_interactive(),
+                hold_unusual=hold_unusual, workers=workers
+            )
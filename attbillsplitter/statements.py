@@ -0,0 +1,262 @@
+# -*- coding:utf-8 -*-
+"""Itemized wireless statements for each line and billing cycle, rendered
+to HTML and PDF files.
+
+Statements are rendered in a process pool. Templates are compiled once per
+process at import time, and PDF files are written by a small pure python
+writer, so no extra dependency is needed.
+"""
+
+from __future__ import division, print_function, unicode_literals
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import io
+from itertools import repeat
+import os
+from string import Template
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+import click
+from attbillsplitter.main import create_tables_if_not_exist
+from attbillsplitter.models import BillingCycle
+from attbillsplitter.reports import get_billing_cycle, iter_line_reports
+from attbillsplitter.services import print_not_found
+
+# plain record sent to worker processes instead of peewee objects
+Statement = namedtuple(
+    'Statement',
+    ['billing_cycle', 'end_date', 'name', 'number', 'charges', 'total']
+)
+
+HTML_TEMPLATE = Template('''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>AT&amp;T Wireless Statement $number $billing_cycle</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; }
+td { padding: 0.2em 1em; }
+td.amount { text-align: right; }
+tr.total td { border-top: 1px solid #000; font-weight: bold; }
+</style>
+</head>
+<body>
+<h1>AT&amp;T Wireless Charges</h1>
+<p>$name ($number)<br>Billing Cycle $billing_cycle</p>
+<table>
+$rows
+<tr class="total"><td>Total</td><td class="amount">$total</td></tr>
+</table>
+</body>
+</html>
+''')
+HTML_ROW_TEMPLATE = Template(
+    '<tr><td>$charge_type</td><td class="amount">$amount</td></tr>'
+)
+
+PDF_PAGE_WIDTH = 612
+PDF_PAGE_HEIGHT = 792
+PDF_MARGIN = 72
+PDF_FONT_SIZE = 11
+PDF_LEADING = 14
+PDF_LINES_PER_PAGE = (PDF_PAGE_HEIGHT - 2 * PDF_MARGIN) // PDF_LEADING
+
+
+def to_statement(report):
+    """Convert a line report to a statement.
+
+    :param report: charge details of a line
+    :type report: LineReport
+    :returns: statement
+    :rtype: Statement
+    """
+    bc = report.billing_cycle
+    return Statement(bc.name, bc.end_date, report.name, report.number,
+                     report.charges, report.total)
+
+
+def render_html(statement):
+    """Render a statement as HTML.
+
+    :param statement: statement
+    :type statement: Statement
+    :returns: html
+    :rtype: str
+    """
+    rows = '\n'.join(
+        HTML_ROW_TEMPLATE.substitute(charge_type=escape(charge_type),
+                                     amount='{:.2f}'.format(amount))
+        for charge_type, amount in statement.charges
+    )
+    return HTML_TEMPLATE.substitute(
+        billing_cycle=escape(statement.billing_cycle),
+        name=escape(statement.name),
+        number=escape(statement.number),
+        rows=rows,
+        total='{:.2f}'.format(statement.total)
+    )
+
+
+def render_text_lines(statement):
+    """Render a statement as lines of plain text for PDF.
+
+    :param statement: statement
+    :type statement: Statement
+    :returns: lines
+    :rtype: list
+    """
+    lines = ['AT&T Wireless Charges',
+             '',
+             '{} ({})'.format(statement.name, statement.number),
+             'Billing Cycle {}'.format(statement.billing_cycle),
+             '']
+    for charge_type, amount in statement.charges:
+        lines.append('  {:40} {:>10.2f}'.format(charge_type, amount))
+    lines.append('  {:40} {:>10}'.format('', '-' * 10))
+    lines.append('  {:40} {:>10.2f}'.format('Total', statement.total))
+    return lines
+
+
+def pdf_string(text):
+    """Encode text as a PDF literal string in latin-1."""
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return b'(' + text.encode('latin-1', 'replace') + b')'
+
+
+def render_pdf(lines):
+    """Render lines of text as a PDF document in a monospaced font.
+
+    :param lines: lines of text
+    :type lines: list
+    :returns: PDF document
+    :rtype: bytes
+    """
+    pages = [lines[i:i + PDF_LINES_PER_PAGE]
+             for i in range(0, len(lines), PDF_LINES_PER_PAGE)] or [[]]
+    # objects 1 and 2 are catalog and page tree, 3 is the font, then a page
+    # and a content stream for each page
+    page_ids = [4 + 2 * i for i in range(len(pages))]
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+            ' '.join('{} 0 R'.format(i) for i in page_ids), len(pages)
+        ).encode('ascii'),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier '
+        b'/Encoding /WinAnsiEncoding >>',
+    ]
+    for page_id, page_lines in zip(page_ids, pages):
+        objects.append(
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {} {}] '
+            '/Resources << /Font << /F1 3 0 R >> >> '
+            '/Contents {} 0 R >>'.format(PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT,
+                                         page_id + 1).encode('ascii')
+        )
+        content = [
+            'BT /F1 {} Tf {} TL {} {} Td'.format(
+                PDF_FONT_SIZE, PDF_LEADING, PDF_MARGIN,
+                PDF_PAGE_HEIGHT - PDF_MARGIN
+            ).encode('ascii')
+        ]
+        content.extend(pdf_string(line) + b" '" for line in page_lines)
+        content.append(b'ET')
+        stream = b'\n'.join(content)
+        objects.append(
+            '<< /Length {} >>\nstream\n'.format(len(stream)).encode('ascii') +
+            stream + b'\nendstream'
+        )
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write('{} 0 obj\n'.format(number).encode('ascii'))
+        out.write(obj)
+        out.write(b'\nendobj\n')
+    xref_offset = out.tell()
+    out.write('xref\n0 {}\n0000000000 65535 f \n'.format(
+        len(objects) + 1).encode('ascii'))
+    for offset in offsets:
+        out.write('{:010d} 00000 n \n'.format(offset).encode('ascii'))
+    out.write('trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n'
+              '%%EOF\n'.format(len(objects) + 1, xref_offset).encode('ascii'))
+    return out.getvalue()
+
+
+def write_statement(statement, output_dir):
+    """Render a statement and write it to HTML and PDF files.
+
+    :param statement: statement
+    :type statement: Statement
+    :param output_dir: directory to write files to
+    :type output_dir: str
+    :returns: paths of the HTML and PDF files
+    :rtype: tuple
+    """
+    basename = os.path.join(output_dir, '{}_{}'.format(
+        statement.end_date.strftime('%Y%m'), statement.number
+    ))
+    html_path = basename + '.html'
+    pdf_path = basename + '.pdf'
+    with io.open(html_path, 'w', encoding='utf-8') as f:
+        f.write(render_html(statement))
+    with open(pdf_path, 'wb') as f:
+        f.write(render_pdf(render_text_lines(statement)))
+    return html_path, pdf_path
+
+
+def render_statements(billing_cycles, output_dir, jobs=None):
+    """Render statements of all lines in billing cycles in a process pool.
+
+    Charges of all billing cycles are fetched with a single query.
+    :param billing_cycles: billing cycles
+    :type billing_cycles: list
+    :param output_dir: directory to write files to
+    :type output_dir: str
+    :param jobs: number of rendering processes. Default to number of CPUs
+    :type jobs: int
+    :yields: tuples of paths of the HTML and PDF files
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    statements = (to_statement(report)
+                  for report in iter_line_reports(billing_cycles))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # send statements to workers in chunks to cut inter-process overhead
+        for paths in executor.map(write_statement, statements,
+                                  repeat(output_dir), chunksize=32):
+            yield paths
+
+
+@click.command()
+@click.argument('month', type=int, required=False)
+@click.option('-y', '--year', type=int)
+@click.option('-o', '--output-dir', default='statements', show_default=True,
+              help='Directory to write statements to.')
+@click.option('-j', '--jobs', type=int,
+              help='Number of processes used to render statements.')
+def run_render_statements(month, year, output_dir, jobs):
+    """Render itemized statements of each user to HTML and PDF files. MONTH
+    refers to the month of the end date of the billing cycle. It should be an
+    integer from 1 to 12. You can also specify YEAR (in 4 digits). By default,
+    YEAR is set to current calendar year. Without MONTH, statements of all
+    billing cycles are rendered.
+    """
+    create_tables_if_not_exist()
+    if month:
+        bc = get_billing_cycle(month, year)
+        if not bc:
+            print_not_found(month, year)
+            return
+
+        bcs = [bc]
+    else:
+        bcs = list(BillingCycle.select())
+    count = 0
+    for _ in render_statements(bcs, output_dir, jobs):
+        count += 1
+    print('\U00002705  {} statements written to {}.'.format(count,
+                                                           output_dir))
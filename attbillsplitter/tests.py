@@ -2,7 +2,97 @@
 """Test cases for att-bill-splitter."""
 
 import datetime as dt
-from attbillsplitter.main import get_start_end_date
+import json
+import logging.handlers
+import os
+import sqlite3
+import threading
+import peewee as pw
+import pytest
+import requests
+import attbillsplitter.analytics as analytics
+from attbillsplitter.api import ApiServer, ConnectionPool
+import attbillsplitter.checkpoint as checkpoint
+from attbillsplitter.archive import archive_billing_cycles, get_cutoff_date
+from attbillsplitter.cache import IdentityMap
+from attbillsplitter.errors import ConfigError, ParsingError
+from attbillsplitter.logs import notification_log
+from attbillsplitter.main import (
+    ACCOUNT_SHARE_TYPE, AttBillSplitter, create_tables_if_not_exist,
+    get_start_end_date, parse_bill, resplit_bill, save_bill
+)
+from attbillsplitter.migrations import (
+    MIGRATIONS, get_schema_version, migrate_database
+)
+from attbillsplitter.models import (
+    User, ChargeCategory, ChargeType, BillingCycle, Charge, ChargeSummary,
+    MonthlyBill, Notification, OutboxMessage, db
+)
+from attbillsplitter.reports import (
+    archived_totals_query, billing_cycle_query, get_billing_cycle,
+    iter_line_reports, monthly_bill_query, notification_query,
+    wireless_charges_query, wireless_totals_query
+)
+import attbillsplitter.metrics as metrics
+import attbillsplitter.outbox as outbox
+import attbillsplitter.services as services
+from attbillsplitter.statements import render_pdf, render_statements
+import attbillsplitter.utils as utils
+
+BILL_HTML = '''
+<div>Account Details</div>
+<div>
+  <div>
+    <div class="accRow bold MarTop10">ALICE 415-555-0001</div>
+  </div>
+  <div class="accSummary">
+    <div>Monthly Charges - Mobile Share Value</div>
+    Mobile Share Value $100.00
+    National Account Discount -$10.00
+    Total Monthly Charges $120.00
+  </div>
+  <div class="accSummary">
+    <div>Surcharges &amp; Fees</div>
+    Total Surcharges &amp; Fees $5.00
+  </div>
+  <div>Total for 415-555-0001</div>
+  <div>
+    <div class="accRow bold MarTop10">BOB 415-555-0002</div>
+  </div>
+  <div class="accSummary">
+    <div>Monthly Charges</div>
+    Total Monthly Charges $15.00
+  </div>
+  <div>Total for 415-555-0002</div>
+  <div>
+    <div class="accRow bold MarTop10">CAROL 415-555-0003</div>
+  </div>
+  <div>Total for 415-555-0003</div>
+</div>
+'''
+
+
+@pytest.fixture
+def database():
+    db.init(':memory:')
+    create_tables_if_not_exist()
+    yield db
+    db.close()
+
+
+class FakeMessageClient(object):
+
+    def __init__(self, failing=()):
+        self.sent = []
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+
+    def send_message(self, body, to):
+        if to in self.failing:
+            raise IOError('Twilio unavailable')
+        with self.lock:
+            self.sent.append(to)
+            return 'SM{}'.format(len(self.sent))
 
 
 def test_get_start_end_date():
@@ -10,3 +100,601 @@ def test_get_start_end_date():
     start_date = dt.date(2016, 3, 15)
     end_date = dt.date(2016, 4, 14)
     assert get_start_end_date(billing_cycle_name) == (start_date, end_date)
+
+
+def test_parse_bill():
+    parsed = parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML)
+    assert parsed.end_date == dt.date(2016, 4, 14)
+    assert parsed.lines == [('ALICE', '415-555-0001'),
+                            ('BOB', '415-555-0002'),
+                            ('CAROL', '415-555-0003')]
+    charges = {(c.number, c.charge_type): c.amount for c in parsed.charges}
+    assert charges == {
+        ('415-555-0001', 'monthly-charges'): 30.0,
+        ('415-555-0001', 'surcharges-fees'): 5.0,
+        ('415-555-0002', 'monthly-charges'): 15.0,
+        ('415-555-0001', ACCOUNT_SHARE_TYPE): 45.0,
+        ('415-555-0002', ACCOUNT_SHARE_TYPE): 45.0,
+    }
+
+
+def test_parse_bill_invalid_page():
+    with pytest.raises(ParsingError):
+        parse_bill('Mar 15 - Apr 14, 2016', '<div>Login</div>')
+
+
+def test_save_bill(database):
+    bc = save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    assert Charge.select().where(Charge.billing_cycle == bc).count() == 5
+    totals = sorted(mb.total for mb in MonthlyBill.select())
+    assert totals == [60.0, 80.0]
+
+
+def test_iter_line_reports(database):
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    bc = get_billing_cycle(4, 2016)
+    reports = list(iter_line_reports([bc]))
+    assert [(r.number, r.total) for r in reports] == [
+        ('415-555-0001', 80.0), ('415-555-0002', 60.0)
+    ]
+    assert reports[1].charges == [
+        ('Monthly Charges', 15.0), ('Account Monthly Charges Share', 45.0)
+    ]
+    assert 'Total' in services.render_message(reports[1])
+    assert get_billing_cycle(5, 2016) is None
+    assert get_billing_cycle(13, 2016) is None
+    assert get_billing_cycle(0, 2016) is None
+
+
+def test_identity_map(database):
+    identity_map = IdentityMap()
+    users = identity_map.get_users([('ALICE', '415-555-0001')])
+    alice = users[('ALICE', '415-555-0001')]
+    users = identity_map.get_users([('ALICE', '415-555-0001'),
+                                    ('BOB', '415-555-0002')])
+    assert users[('ALICE', '415-555-0001')] is alice
+    assert User.select().count() == 2
+    # rows added by another writer are picked up after a reload
+    User.create(name='CAROL', number='415-555-0003')
+    identity_map.invalidate()
+    users = identity_map.get_users([('CAROL', '415-555-0003')])
+    assert User.select().count() == 3
+
+
+def test_migrate_database():
+    db.init(':memory:')
+    # tables created before migrations existed
+    for model in (User, ChargeCategory, ChargeType, BillingCycle, Charge,
+                  MonthlyBill):
+        model.create_table()
+    db.execute_sql('ALTER TABLE billingcycle DROP COLUMN archived_at')
+    assert get_schema_version() == 0
+    assert migrate_database() == list(range(1, len(MIGRATIONS) + 1))
+    assert get_schema_version() == len(MIGRATIONS)
+    assert migrate_database() == []
+    indexes = [index.name for index in db.get_indexes('charge')]
+    assert 'charge_billing_cycle_id_user_id_charge_type_id_amount' in indexes
+    columns = [column.name for column in db.get_columns('billingcycle')]
+    assert 'archived_at' in columns
+    db.close()
+
+
+def explain(query):
+    sql, params = query.sql()
+    cursor = db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+@pytest.mark.parametrize('query', [
+    lambda: billing_cycle_query(4, 2016),
+    lambda: wireless_charges_query([1, 2, 3]),
+    lambda: wireless_totals_query(1),
+    lambda: monthly_bill_query(1),
+    lambda: archived_totals_query([1, 2, 3]),
+    lambda: notification_query(1, 1),
+])
+def test_report_query_plans(database, query):
+    for detail in explain(query()):
+        assert not detail.startswith('SCAN'), detail
+
+
+def test_get_cutoff_date():
+    assert get_cutoff_date(24, dt.date(2016, 4, 14)) == dt.date(2014, 4, 1)
+    assert get_cutoff_date(4, dt.date(2016, 4, 14)) == dt.date(2015, 12, 1)
+
+
+def test_archive_billing_cycles(database, tmpdir):
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    archive_path = str(tmpdir.join('archive.db'))
+    bcs = archive_billing_cycles(1, archive_path)
+    assert [bc.name for bc in bcs] == ['Mar 15 - Apr 14, 2016']
+    assert Charge.select().count() == 0
+    assert ChargeSummary.select(
+        pw.fn.SUM(ChargeSummary.total)).scalar() == 140.0
+    bc = get_billing_cycle(4, 2016)
+    reports = list(iter_line_reports([bc]))
+    assert [(r.total, r.charges) for r in reports] == [(80.0, []),
+                                                       (60.0, [])]
+    archive = sqlite3.connect(archive_path)
+    assert archive.execute('SELECT COUNT(*) FROM charge').fetchone() == (5,)
+    assert archive_billing_cycles(1, archive_path) == []
+
+
+def test_archive_columns_differ(database, tmpdir):
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    archive_path = str(tmpdir.join('archive.db'))
+    # archive created by an older version, without a column added since
+    archive = sqlite3.connect(archive_path)
+    archive.execute('CREATE TABLE charge (amount REAL, id INTEGER, '
+                    'billing_cycle_id INTEGER, user_id INTEGER, '
+                    'charge_type_id INTEGER)')
+    archive.commit()
+    archive_billing_cycles(1, archive_path)
+    rows = archive.execute('SELECT SUM(amount), MAX(billing_cycle_id), '
+                           'COUNT(created_at) FROM charge').fetchone()
+    assert rows == (140.0, 1, 5)
+    archive.close()
+
+
+def test_notify_users_monthly_details(database, tmpdir, monkeypatch):
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    monkeypatch.setattr(services, 'input', lambda prompt: 'y')
+    client = FakeMessageClient()
+    log_path = str(tmpdir.join('notif.jsonl'))
+    parent_logger = logging.getLogger('attbillsplitter')
+    with notification_log(parent_logger, log_path):
+        services.notify_users_monthly_details(client, 'Pay me', 4, 2016)
+    assert client.sent == ['415-555-0001', '415-555-0002']
+    bc = get_billing_cycle(4, 2016)
+    notification = services.get_last_notification(bc.id, 2)
+    assert notification.message_sid == 'SM2'
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f]
+    assert [(r['event'], r['number']) for r in records] == [
+        ('charge details queued', '415-555-0001'),
+        ('charge details queued', '415-555-0002'),
+        ('charge details sent', '415-555-0001'),
+        ('charge details sent', '415-555-0002'),
+    ]
+    assert records[0]['billing_cycle'] == 'Mar 15 - Apr 14, 2016'
+    assert not any(isinstance(h, logging.handlers.QueueHandler)
+                   for h in parent_logger.handlers)
+    # delivered messages are not sent again
+    services.notify_users_monthly_details(client, 'Pay me', 4, 2016)
+    assert len(client.sent) == 2
+
+
+def test_notify_users_skipped_lines(database, capsys):
+    bc = save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    # notified before the outbox existed
+    Notification.create(billing_cycle=bc, user=1, message_sid='SM0')
+    # left sending by a run that died
+    outbox.enqueue(bc, 2, '415-555-0002', 'Hi')
+    outbox.claim([bc.id], dt.datetime.utcnow())
+    client = FakeMessageClient()
+    services.notify_users_monthly_details(client, 'Pay me', 4, 2016,
+                                          confirm=False)
+    assert client.sent == []
+    out = capsys.readouterr().out
+    assert 'Already sent to 415-555-0001' in out
+    assert '1 messages left sending by a run that did not finish were not ' \
+        'sent again: 415-555-0002' in out
+
+
+def test_outbox_dispatch(tmpdir):
+    # dispatcher threads need a database shared between connections
+    db.init(str(tmpdir.join('att_bill.db')))
+    create_tables_if_not_exist()
+    bc = save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    for user_id in (1, 2, 3):
+        assert outbox.enqueue(bc, user_id, '415-555-000{}'.format(user_id),
+                              'Hi')
+    outbox.cancel(bc, 3)
+    client = FakeMessageClient(failing=['415-555-0002'])
+    assert outbox.dispatch(client, [bc], workers=2) == (1, 1)
+    message = outbox.get_message(bc, 2)
+    assert (message.status, message.attempts) == ('failed', 1)
+    assert message.error.endswith(': Twilio unavailable')
+    # a message left sending by a run that died is only sent on request
+    OutboxMessage.update(
+        status='sending', claimed_at=dt.datetime.utcnow()
+    ).where(OutboxMessage.id == message.id).execute()
+    client.failing = set()
+    assert outbox.dispatch(client, [bc], workers=2) == (0, 0)
+    assert [m.number for m in outbox.get_sending([bc])] == ['415-555-0002']
+    assert not outbox.enqueue(bc, 2, '415-555-0002', 'Hi')
+    assert outbox.enqueue(bc, 2, '415-555-0002', 'Hi', resend=True)
+    assert outbox.dispatch(client, [bc], workers=2) == (1, 0)
+    assert outbox.dispatch(client, [bc], workers=2) == (0, 0)
+    assert not outbox.enqueue(bc, 1, '415-555-0001', 'Hi again')
+    assert client.sent == ['415-555-0001', '415-555-0002']
+    assert Notification.select().count() == 2
+    db.close()
+
+
+def test_outbox_delivery_not_recorded(database, monkeypatch):
+    bc = save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    for user_id in (1, 2):
+        outbox.enqueue(bc, user_id, '415-555-000{}'.format(user_id), 'Hi')
+
+    def locked(message, message_sid):
+        raise pw.OperationalError('database is locked')
+
+    monkeypatch.setattr(outbox, 'mark_delivered', locked)
+    client = FakeMessageClient(failing=['415-555-0002'])
+    assert outbox.dispatch(client, [bc]) == (1, 1)
+    # the message sent is not sent again
+    assert [m.number for m in outbox.get_sending([bc])] == ['415-555-0001']
+
+
+def test_resplit_bill(database):
+    parsed = parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML)
+    save_bill(parsed)
+    assert resplit_bill(parsed) == (0, 0, 0)
+    # a corrected bill: surcharges removed, one amount changed, one added
+    charges = [c for c in parsed.charges if c.charge_type != 'surcharges-fees']
+    charges[0] = charges[0]._replace(amount=25.0)
+    charges.append(charges[1]._replace(charge_type='equipment-charges',
+                                       text='Equipment Charges'))
+    assert resplit_bill(parsed._replace(charges=charges)) == (1, 1, 1)
+    totals = sorted(mb.total for mb in MonthlyBill.select())
+    assert totals == [70.0, 75.0]
+    assert Charge.select().count() == 5
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_charge_store(database, monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(analytics, 'np', None)
+    elif analytics.np is None:
+        pytest.skip('numpy not installed')
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    save_bill(parse_bill('Jan 15 - Feb 14, 2017', BILL_HTML))
+    store = analytics.ChargeStore.load()
+    assert len(store) == 10
+    assert store.yearly_totals() == {
+        ('415-555-0001', 2016): 80.0, ('415-555-0002', 2016): 60.0,
+        ('415-555-0001', 2017): 80.0, ('415-555-0002', 2017): 60.0,
+    }
+    assert store.type_trend('Monthly Charges') == [
+        ('Mar 15 - Apr 14, 2016', 45.0), ('Jan 15 - Feb 14, 2017', 45.0)
+    ]
+    bob = store.filter(users=['415-555-0002'])
+    assert len(bob) == 4
+    assert bob.group_sum() == {(): 120.0}
+
+
+def test_find_anomalies(database):
+    if analytics.np is None:
+        pytest.skip('numpy not installed')
+    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun']
+    for start, end in zip(months, months[1:]):
+        save_bill(parse_bill('{} 15 - {} 14, 2016'.format(start, end),
+                             BILL_HTML))
+    parsed = parse_bill('Jun 15 - Jul 14, 2016', BILL_HTML)
+    charges = [c._replace(amount=50.0) if c.charge_type == 'surcharges-fees'
+               else c for c in parsed.charges]
+    save_bill(parsed._replace(charges=charges))
+    store = analytics.ChargeStore.load()
+    anomaly, = analytics.find_anomalies(store)
+    assert anomaly.billing_cycle == 'Jun 15 - Jul 14, 2016'
+    assert anomaly.number == '415-555-0001'
+    assert anomaly.amount == 50.0 and anomaly.baseline == 5.0
+    assert anomaly.z_score == 45.0
+    assert analytics.find_anomalies(store, ['May 15 - Jun 14, 2016']) == []
+    bc = get_billing_cycle(7, 2016)
+    assert list(services.get_unusual_charges(bc)) == ['415-555-0001']
+
+
+def test_render_pdf():
+    pdf = render_pdf(['AT&T (Wireless)'] * 60)
+    assert pdf.startswith(b'%PDF-1.4\n')
+    assert pdf.endswith(b'%%EOF\n')
+    assert b'/Count 2' in pdf
+    assert b'(AT&T \\(Wireless\\)) \'' in pdf
+    # xref offsets point at objects
+    xref_offset = int(pdf.rsplit(b'startxref\n', 1)[1].split(b'\n')[0])
+    first_offset = int(pdf[xref_offset:].split(b'\n')[3][:10])
+    assert pdf[first_offset:].startswith(b'1 0 obj')
+
+
+def test_render_statements(database, tmpdir):
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    output_dir = str(tmpdir.join('statements'))
+    paths = list(render_statements([get_billing_cycle(4, 2016)], output_dir,
+                                   jobs=1))
+    assert [os.path.basename(html) for html, _ in paths] == [
+        '201604_415-555-0001.html', '201604_415-555-0002.html'
+    ]
+    html = tmpdir.join('statements', '201604_415-555-0002.html').read()
+    assert '<td>Account Monthly Charges Share</td>' in html
+    assert '60.00' in html
+
+
+@pytest.fixture
+def config(tmpdir, monkeypatch):
+    path = tmpdir.join('attbillsplitter.conf')
+    path.write('[twilio]\naccount_sid = AC123\nauth_token = token\n'
+               'number = +14155550000\n')
+    monkeypatch.setattr(utils, 'CONFIG_PATH', str(path))
+    monkeypatch.setattr(utils, '_overrides', {})
+    monkeypatch.setattr(utils, '_non_interactive', False)
+    monkeypatch.delenv(utils.NON_INTERACTIVE_ENV, raising=False)
+    utils.reset_config()
+    yield path
+    utils.reset_config()
+
+
+def test_get_config_value(config, monkeypatch):
+    assert utils.get_config_value('twilio', 'auth_token') == 'token'
+    # config file is parsed once per process
+    config.write('[twilio]\nauth_token = changed\n')
+    assert utils.get_config_value('twilio', 'auth_token') == 'token'
+    monkeypatch.setenv('ATTBS_TWILIO_AUTH_TOKEN', 'env')
+    assert utils.get_config_value('twilio', 'auth_token') == 'env'
+    utils.set_config_override('twilio', 'auth_token', 'cli')
+    assert utils.get_config_value('twilio', 'auth_token') == 'cli'
+    assert utils.get_config_value('att', 'username') is None
+
+
+def test_non_interactive_config(config, monkeypatch):
+    monkeypatch.setenv(utils.NON_INTERACTIVE_ENV, '1')
+    assert utils.is_non_interactive()
+    with pytest.raises(ConfigError) as e:
+        utils.require_config_value('att', 'username', 'AT&T Username')
+    assert 'ATTBS_ATT_USERNAME' in str(e.value)
+    with pytest.raises(ConfigError):
+        utils.load_payment_msg()
+    monkeypatch.setenv('ATTBS_MESSAGE_PAYMENT', 'Venmo me')
+    assert utils.load_payment_msg() == 'Venmo me'
+    assert utils.load_twilio_config() == ('+14155550000', 'AC123', 'token')
+
+
+def test_metrics_registry(database, tmpdir):
+    registry = metrics.Registry()
+    sent = registry.register(metrics.Counter('sms_sent_total', 'Sent.'))
+    latency = registry.register(
+        metrics.Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+    )
+    statements = registry.register(
+        metrics.Histogram('statements', 'Statements.', buckets=(10,))
+    )
+    assert registry.register(metrics.Counter('sms_sent_total', '')) is sent
+    sent.inc()
+    latency.observe(0.05)
+    latency.observe(0.5)
+    with metrics.count_statements(database, statements):
+        save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    assert statements.count == 1 and statements.sum > 10
+
+    text_path = str(tmpdir.join('attbs.prom'))
+    registry.write(text_path)
+    with open(text_path) as f:
+        lines = f.read().splitlines()
+    assert '# TYPE attbs_sms_sent_total counter' in lines
+    assert 'attbs_sms_sent_total 1' in lines
+    assert 'attbs_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'attbs_latency_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'attbs_latency_seconds_sum 0.55' in lines
+    json_path = str(tmpdir.join('attbs.json'))
+    registry.write(json_path)
+    with open(json_path) as f:
+        snapshot = json.load(f)
+    assert snapshot['attbs_latency_seconds']['buckets'] == {
+        '0.1': 1, '1.0': 2, '+Inf': 2
+    }
+    # temporary files are renamed into place
+    assert sorted(os.listdir(str(tmpdir))) == ['attbs.json', 'attbs.prom']
+
+
+@pytest.mark.parametrize('filename', ['attbs.prom', 'attbs.json'])
+def test_run_metrics_shared_path(tmpdir, filename):
+    path = str(tmpdir.join(filename))
+    name = 'attbs_last_success_timestamp_seconds'
+    # each run is a new process with its own registry
+    with metrics.run_metrics('split', path, metrics.Registry()):
+        pass
+    split_success = metrics.read_value(path, name, 'split')
+    assert split_success > 0
+    notify_metrics = metrics.Registry()
+    notify_metrics.register(metrics.Counter('sms_sent_total', 'Sent.')).inc()
+    with metrics.run_metrics('notify', path, notify_metrics):
+        pass
+    notify_success = metrics.read_value(path, name, 'notify')
+    assert notify_success > 0
+    assert metrics.read_value(path, name, 'split') == split_success
+
+    with pytest.raises(RuntimeError):
+        with metrics.run_metrics('split', path, metrics.Registry()):
+            raise RuntimeError('AT&T is down')
+    assert metrics.read_value(path, name, 'split') == split_success
+    assert metrics.read_value(path, name, 'notify') == notify_success
+    if filename.endswith('.prom'):
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert lines.count('# TYPE {} gauge'.format(name)) == 1
+        assert 'attbs_sms_sent_total{command="notify"} 1' in lines
+
+
+
+class FakeSplitter(AttBillSplitter):
+
+    def login(self):
+        return True
+
+    def fetch_bill(self, bill_link, session=None):
+        if session is not None:
+            self.sessions.add(session)
+        if bill_link in self.broken_links:
+            raise requests.ConnectionError('Connection reset')
+        return BILL_HTML
+
+
+def test_split_bills_checkpoint(tmpdir):
+    # writer thread needs a database shared between connections
+    db.init(str(tmpdir.join('att_bill.db')))
+    create_tables_if_not_exist()
+    bills = [('Mar 15 - Apr 14, 2016', 'link1'),
+             ('Apr 15 - May 14, 2016', 'link2')]
+    splitter = FakeSplitter('alice', 'secret')
+    splitter.broken_links = {'link2'}
+    splitter.sessions = set()
+    splitter.session.cookies.set('SMSESSION', 'token')
+    checkpoint.add_pending('alice', bills)
+    assert splitter.split_bills(bills, jobs=1) == ['Apr 15 - May 14, 2016']
+    assert checkpoint.get_progress('alice') == {
+        'done': 1, 'failed': 1, 'pending': 0
+    }
+    cycle, = checkpoint.get_unfinished('alice')
+    assert cycle.attempts == 1
+    assert cycle.error == 'ConnectionError: Connection reset'
+    # cycles done are never queued again
+    checkpoint.add_pending('alice', bills)
+    assert checkpoint.get_progress('alice')['pending'] == 1
+
+    splitter.broken_links = set()
+    splitter.resume(jobs=1, retry_jobs=2)
+    assert checkpoint.get_unfinished('alice') == []
+    # download threads use their own copy of the logged-in session
+    assert [error for _, _, error in splitter.fetch_bills(bills, 2)] == \
+        [None, None]
+    session = splitter.sessions.pop()
+    assert session is not splitter.session
+    assert session.cookies.get('SMSESSION') == 'token'
+    assert BillingCycle.select().count() == 2
+    db.close()
+
+
+def test_api(tmpdir, monkeypatch):
+    path = str(tmpdir.join('att_bill.db'))
+    db.init(path)
+    create_tables_if_not_exist()
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    save_bill(parse_bill('Apr 15 - May 14, 2016', BILL_HTML))
+    db.close()
+    pool = ConnectionPool(path, size=2)
+    server = ApiServer(('127.0.0.1', 0), pool)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        r = requests.get(url + '/billing-cycles', params={'per_page': 1})
+        assert r.json()['total'] == 2
+        assert r.json()['next_page'] == 2
+        cycle, = r.json()['items']
+        assert cycle['name'] == 'Apr 15 - May 14, 2016'
+
+        details_url = '{}/billing-cycles/{}/details'.format(url, cycle['id'])
+        r = requests.get(details_url)
+        assert r.status_code == 200
+        alice, bob = r.json()['items']
+        assert bob['number'] == '415-555-0002' and bob['total'] == 60.0
+        assert {'charge_type': 'Monthly Charges', 'amount': 15.0} in \
+            bob['charges']
+        assert r.json()['wireless_total'] == 140.0
+        r = requests.get(details_url,
+                         headers={'If-None-Match': r.headers['ETag']})
+        assert r.status_code == 304 and r.content == b''
+        r = requests.get(
+            details_url,
+            headers={'If-Modified-Since': r.headers['Last-Modified']}
+        )
+        assert r.status_code == 304
+        # a write within the same second of Last-Modified changes the ETag
+        etag = r.headers['ETag']
+        Charge.delete().where(Charge.billing_cycle == cycle['id'],
+                              Charge.user == 2).execute()
+        db.close()
+        r = requests.get(details_url, headers={'If-None-Match': etag})
+        assert r.status_code == 200 and r.json()['wireless_total'] == 80.0
+        assert requests.get(url + '/billing-cycles/99/summary').status_code \
+            == 404
+        assert requests.get(url + '/billing-cycles',
+                            params={'page': 2 ** 62}).status_code == 400
+        assert requests.get(
+            url + '/billing-cycles/99999999999999999999/summary'
+        ).status_code == 404
+        assert requests.get(url + '/billing-cycles?page=0').status_code == 400
+        # pooled connections are read-only
+        with pool.connection() as conn:
+            with pytest.raises(sqlite3.OperationalError):
+                conn.execute('DELETE FROM charge')
+        assert pool.opened <= 2
+
+        def locked(query):
+            raise sqlite3.OperationalError('database is locked')
+
+        monkeypatch.setattr(pool, 'execute', locked)
+        r = requests.get(url + '/billing-cycles')
+        assert r.status_code == 500
+        assert r.json() == {'error': 'OperationalError: database is locked'}
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        pool.close()
+
+
+def test_count_segments():
+    assert services.count_segments('a' * 160) == 1
+    assert services.count_segments('a' * 161) == 2
+    assert services.count_segments('a' * 306) == 2
+    assert services.count_segments('€' * 81) == 2
+    assert services.count_segments('\U0001F911' * 35) == 1
+    assert services.count_segments('\U0001F911' * 36) == 2
+
+
+def test_notify_users_digest(database):
+    bcs = [save_bill(parse_bill(name, BILL_HTML)) for name in (
+        'Mar 15 - Apr 14, 2016', 'Apr 15 - May 14, 2016',
+        'May 15 - Jun 14, 2016'
+    )]
+    Notification.create(billing_cycle=bcs[0], user=1)
+    client = FakeMessageClient()
+    services.notify_users_digest(client, 'Pay me', confirm=False)
+    # one message per line whatever the number of billing cycles
+    assert client.sent == ['415-555-0001', '415-555-0002']
+    body = outbox.get_message(bcs[2], 1).body
+    assert body.splitlines()[2:] == [
+        'May 2016: 80.00', 'Jun 2016: 80.00', 'Total: 160.00', 'Pay me'
+    ]
+    assert Notification.select().count() == 6
+    services.notify_users_digest(client, 'Pay me', confirm=False)
+    assert len(client.sent) == 2
+    # billing cycles covered by a digest are not sent again monthly
+    for month in (4, 5, 6):
+        services.notify_users_monthly_details(client, 'Pay me', month, 2016,
+                                              confirm=False)
+    assert len(client.sent) == 2
+    # oldest billing cycles are folded to fit in segments
+    cycles = [(bc, 10.0) for bc in bcs] * 8
+    body = services.render_digest('ALICE', '415-555-0001', cycles, 'Pay me',
+                                  max_segments=1)
+    assert services.count_segments(body) == 1
+    assert 'Earlier (' in body and 'Total: 240.00' in body
+    # a message that cannot fit is not rendered, nor sent
+    assert services.render_digest('ALICE', '415-555-0001', cycles,
+                                  'Pay me ' * 30, max_segments=1) is None
+
+
+def test_notify_users_digest_over_segments(database, capsys):
+    save_bill(parse_bill('Mar 15 - Apr 14, 2016', BILL_HTML))
+    client = FakeMessageClient()
+    services.notify_users_digest(client, 'Pay me ' * 30, confirm=False,
+                                 max_segments=1)
+    assert client.sent == []
+    assert OutboxMessage.select().count() == 0
+    assert 'does not fit in 1 segments' in capsys.readouterr().out
+
+
+def test_digest_delivery_keeps_single_notification(database):
+    bcs = [save_bill(parse_bill(name, BILL_HTML)) for name in (
+        'Mar 15 - Apr 14, 2016', 'Apr 15 - May 14, 2016'
+    )]
+    assert outbox.enqueue(bcs[1], 1, '415-555-0001', 'Hi', [bcs[0].id])
+    # a monthly run notified the earlier billing cycle meanwhile
+    Notification.create(billing_cycle=bcs[0], user=1, message_sid='SM0')
+    assert outbox.dispatch(FakeMessageClient(), bcs) == (1, 0)
+    assert sorted(
+        (n.billing_cycle_id, n.message_sid) for n in Notification.select()
+    ) == [(bcs[0].id, 'SM0'), (bcs[1].id, 'SM1')]
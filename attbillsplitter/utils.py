@@ -10,13 +10,141 @@ except:
 import os
 import sys
 import warnings
+import click
+from attbillsplitter.errors import ConfigError
 
 CONFIG_PATH = os.path.expanduser('~/.attbillsplitter.conf')
 PAGE_LOADING_WAIT_S = 10
 DATABASE_PATH = 'att_bill.db'
-LOG_PATH = 'notif_history.log'
+ARCHIVE_DATABASE_PATH = 'att_bill_archive.db'
+LOG_PATH = 'notif_history.jsonl'
+# environment variables named ATTBS_<SECTION>_<OPTION> override config file,
+# e.g. ATTBS_TWILIO_AUTH_TOKEN for auth_token in [twilio] section
+ENV_PREFIX = 'ATTBS'
+NON_INTERACTIVE_ENV = 'ATTBS_NON_INTERACTIVE'
 warnings.simplefilter('ignore')
 
+_config = None
+_overrides = {}
+_non_interactive = False
+
+
+def load_config():
+    """Load config file. It is parsed once per process.
+
+    :returns: parsed config
+    :rtype: ConfigParser
+    """
+    global _config
+    if _config is None:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_PATH)
+        _config = config
+    return _config
+
+
+def reset_config():
+    """Drop cached config so that config file is parsed again on next load.
+
+    :returns: None
+    """
+    global _config
+    _config = None
+
+
+def set_config_override(section, option, value):
+    """Override a config value for this process, e.g. from a CLI option.
+
+    :returns: None
+    """
+    _overrides[(section, option)] = value
+
+
+def get_config_override(section, option):
+    """Get a config value set by CLI option or environment variable.
+
+    :returns: config value, None if not overridden
+    :rtype: str
+    """
+    if _overrides.get((section, option)) is not None:
+        return _overrides[(section, option)]
+
+    env_name = '{}_{}_{}'.format(ENV_PREFIX, section, option).upper()
+    return os.environ.get(env_name)
+
+
+def get_config_value(section, option):
+    """Get a config value from CLI options, environment variables and config
+    file, in that order.
+
+    :param section: config section
+    :type section: str
+    :param option: config option
+    :type option: str
+    :returns: config value, None if not configured
+    :rtype: str
+    """
+    value = get_config_override(section, option)
+    if value is not None:
+        return value
+
+    config = load_config()
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return None
+
+
+def set_non_interactive(non_interactive=True):
+    """Never prompt in this process. Missing config raises ConfigError.
+
+    :returns: None
+    """
+    global _non_interactive
+    _non_interactive = non_interactive
+
+
+def is_non_interactive():
+    """Check if prompts are disabled by `set_non_interactive` or by
+    ATTBS_NON_INTERACTIVE environment variable.
+
+    :rtype: bool
+    """
+    return _non_interactive or os.environ.get(NON_INTERACTIVE_ENV,
+                                              '') not in ('', '0')
+
+
+def require_config_value(section, option, prompt, hide_input=False):
+    """Get a config value, prompt for it if it is not configured.
+
+    :param section: config section
+    :type section: str
+    :param option: config option
+    :type option: str
+    :param prompt: text of the prompt
+    :type prompt: str
+    :param hide_input: hide typed value, for passwords
+    :type hide_input: bool
+    :returns: config value
+    :rtype: str
+    """
+    value = get_config_value(section, option)
+    if value is not None:
+        return value
+
+    if is_non_interactive():
+        raise ConfigError(missing_config_message(section, option))
+
+    return click.prompt(prompt, hide_input=hide_input)
+
+
+def missing_config_message(section, *options):
+    """Explain how to set missing config options without prompting."""
+    return 'Missing {} in [{}] section of {}. Set {} instead.'.format(
+        ', '.join(options), section, CONFIG_PATH,
+        ', '.join('{}_{}_{}'.format(ENV_PREFIX, section, option).upper()
+                  for option in options)
+    )
+
 
 def initialize_twiolio():
     """Initialize twilio credentials from command line input and save in
@@ -38,6 +166,7 @@ def initialize_twiolio():
     config.set('twilio', 'auth_token', auth_token)
     with open(CONFIG_PATH, 'w') as configfile:
         config.write(configfile)
+    reset_config()
     print('\U00002705  New twilio account added.')
 
 
@@ -47,17 +176,16 @@ def load_twilio_config():
     :returns: a tuple of twilio number, sid and auth token
     :rtype: tuple
     """
-    config = configparser.ConfigParser()
-    config.read(CONFIG_PATH)
+    options = ('number', 'account_sid', 'auth_token')
+    values = tuple(get_config_value('twilio', o) for o in options)
     # initialize twilio if not yet initialized
-    if 'twilio' not in config.sections():
-        initialize_twiolio()
-        config.read(CONFIG_PATH)
+    if None in values:
+        if is_non_interactive():
+            raise ConfigError(missing_config_message('twilio', *options))
 
-    number = config.get('twilio', 'number')
-    account_sid = config.get('twilio', 'account_sid')
-    auth_token = config.get('twilio', 'auth_token')
-    return (number, account_sid, auth_token)
+        initialize_twiolio()
+        values = tuple(get_config_value('twilio', o) for o in options)
+    return values
 
 
 def initialize_payment_msg():
@@ -78,34 +206,38 @@ def initialize_payment_msg():
     config.set('message', 'payment', message)
     with open(CONFIG_PATH, 'w') as configfile:
         config.write(configfile)
+    reset_config()
     print('\U00002705  New payment message saved.')
 
 
 def load_payment_msg():
     """Load payment message. Prompt to initialize if not yet initialized.
+    Message set by CLI option or environment variable is used as is.
 
-    :returns: payment message cached in config file
+    :returns: payment message
     :rtype: str
     """
-    config = configparser.ConfigParser()
-    config.read(CONFIG_PATH)
-    # initialize twilio if not yet initialized
-    if ('message' not in config.sections() or
-            'payment' not in [t for (t, _) in config.items('message')]):
-        initialize_payment_msg()
-        config.read(CONFIG_PATH)
+    message = get_config_value('message', 'payment')
+    # initialize payment message if not yet initialized
+    if message is None:
+        if is_non_interactive():
+            raise ConfigError(missing_config_message('message', 'payment'))
 
-    else:
-        message = config.get('message', 'payment')
-        prompt = ('\U00002753  Do you want to keep using the following '
-                  'message: \n{}\n(y/n)? '.format(message))
-        try:
-            # python3
-            reset = input(prompt)
-        except UnicodeEncodeError:
-            # python2
-            reset = input(prompt.encode(sys.stdout.encoding))
-        if reset in ('n', 'N', 'no', 'No', 'No'):
-            initialize_payment_msg()
-            config.read(CONFIG_PATH)
-    return config.get('message', 'payment')
+        initialize_payment_msg()
+        return get_config_value('message', 'payment')
+
+    if is_non_interactive() or get_config_override('message', 'payment'):
+        return message
+
+    prompt = ('\U00002753  Do you want to keep using the following '
+              'message: \n{}\n(y/n)? '.format(message))
+    try:
+        # python3
+        reset = input(prompt)
+    except UnicodeEncodeError:
+        # python2
+        reset = input(prompt.encode(sys.stdout.encoding))
+    if reset in ('n', 'N', 'no', 'No', 'No'):
+        initialize_payment_msg()
+        message = get_config_value('message', 'payment')
+    return message
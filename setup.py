@@ -16,6 +16,7 @@ setup(
         'beautifulsoup4==4.5.1',
         'click>=6.6',
         'future>=0.16.0',
+        'futures>=3.0.5;python_version<"3"',
         # 'lxml==3.6.4',
         'peewee>=2.8.4',
         'python-slugify>=1.2.1',
@@ -25,6 +26,9 @@ setup(
     ],
     packages=find_packages(),
     extras_require={
+        'analytics': [
+            'numpy>=1.13'
+        ],
         'testing': [
             'pytest>=2.9.2'
         ]
@@ -32,9 +36,17 @@ setup(
     entry_points={
         'console_scripts': [
             'att-split-bill=attbillsplitter.entrypoints:split_bill',
+            'att-resume-split=attbillsplitter.entrypoints:resume_split',
+            'att-migrate-db=attbillsplitter.entrypoints:migrate_db',
+            'att-archive=attbillsplitter.entrypoints:archive',
             'att-print-summary=attbillsplitter.entrypoints:print_summary',
             'att-print-details=attbillsplitter.entrypoints:print_details',
+            'att-render-statements='
+            'attbillsplitter.entrypoints:render_statements',
+            'att-find-anomalies=attbillsplitter.entrypoints:find_anomalies',
+            'att-serve-api=attbillsplitter.entrypoints:serve_api',
             'att-notify-users=attbillsplitter.entrypoints:notify_users',
+            'att-notify-digest=attbillsplitter.entrypoints:notify_digest',
             'att-init-twilio=attbillsplitter.entrypoints:init_twilio',
             'att-init-payment-msg=attbillsplitter.entrypoints:init_payment_msg'
         ],